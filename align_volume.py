@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Căn câu hàng loạt cho một quyển sách (bước "đối chiếu" trong pipeline.txt)
+
+    (1) câu tiếng Hán đã dịch máy sang tiếng Việt  -> embedding
+    (2) câu tiếng Việt gốc trong sách               -> embedding
+    đối chiếu (1) với (2) theo ngưỡng               -> cột best_match
+
+Hai phía được encode theo batch, độ tương đồng chỉ tính trong dải trang
+(hoặc cửa sổ câu) quanh vị trí của câu nguồn thay vì mọi cặp, rồi chọn
+cách ghép đơn điệu (thứ tự câu trong sách không đi lùi) có tổng điểm lớn nhất.
+Kết quả có cùng schema với file CSV của corpus:
+Page, Câu tiếng Hán, volumn, translation, best_match
+
+Cách dùng:
+    python align_volume.py translated.csv book.csv output.csv --volume Volume_34
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+from han_viet_search_system import preprocess_texts, load_phobert_model, phobert_encode
+
+OUTPUT_COLUMNS = ['Page', 'Câu tiếng Hán', 'volumn', 'translation', 'best_match']
+
+
+def read_book(book_path, column=None):
+    """Đọc câu tiếng Việt trong sách: .csv (cột Page + cột câu) hoặc .txt (mỗi dòng một câu, không có trang)"""
+    if book_path.lower().endswith('.csv'):
+        book = pd.read_csv(book_path)
+        column = column or next(
+            (c for c in ('best_match', 'Câu tiếng Việt', 'sentence') if c in book.columns),
+            book.columns[-1]
+        )
+        book = book.rename(columns={column: 'sentence'})
+    else:
+        with open(book_path, encoding='utf-8') as f:
+            book = pd.DataFrame({'sentence': [line.strip() for line in f]})
+    book = book[book['sentence'].notna() & (book['sentence'].astype(str).str.strip() != '')]
+    return book.reset_index(drop=True)
+
+
+def encode_sorted(texts, tokenizer, model, device, batch_size=64):
+    """Encode theo thứ tự độ dài để mỗi batch ít padding, trả về embeddings đã chuẩn hóa theo thứ tự ban đầu"""
+    order = np.argsort([len(t) for t in texts], kind='stable')
+    embeddings = phobert_encode([texts[i] for i in order], tokenizer, model, device, batch_size=batch_size)
+    result = torch.empty_like(embeddings)
+    result[torch.as_tensor(order)] = embeddings
+    return F.normalize(result.float(), dim=1)
+
+
+def _bands(source_pages, target_pages, n_source, n_target, page_window, window):
+    """Khoảng [lo, hi) câu trong sách được so với mỗi câu nguồn"""
+    if source_pages is not None and target_pages is not None:
+        lo = np.searchsorted(target_pages, source_pages - page_window, side='left')
+        hi = np.searchsorted(target_pages, source_pages + page_window, side='right')
+    else:
+        # Không có số trang: dải chéo theo vị trí tương đối trong quyển
+        center = np.round(np.arange(n_source) * n_target / max(n_source, 1)).astype(int)
+        lo = np.clip(center - window, 0, n_target)
+        hi = np.clip(center + window + 1, 0, n_target)
+    return lo, hi
+
+
+def monotonic_align(source_emb, target_emb, lo, hi, threshold=0.7):
+    """Quy hoạch động trên dải tương đồng: chọn câu trong sách cho mỗi câu nguồn sao cho
+    chỉ số câu không giảm và tổng điểm các cặp >= threshold là lớn nhất.
+
+    Nhiều câu nguồn có thể cùng ghép vào một câu trong sách (câu Hán thường ngắn hơn câu
+    tiếng Việt); câu nguồn không có cặp nào vượt ngưỡng thì để trống.
+    Trả về (chỉ số câu trong sách hoặc -1, điểm) cho từng câu nguồn.
+    """
+    n_source, n_target = source_emb.shape[0], target_emb.shape[0]
+    best = np.zeros(n_target)                       # tổng điểm tốt nhất khi câu ghép cuối là j
+    node_of = np.full(n_target, -1)                 # nút cuối của chuỗi ghép tương ứng
+    nodes = []                                      # (câu nguồn, câu sách, điểm, nút trước)
+
+    # Tính ma trận tương đồng theo từng khối câu nguồn có chung dải
+    block_start = 0
+    while block_start < n_source:
+        block_end = block_start + 1
+        while block_end < n_source and lo[block_end] == lo[block_start] and hi[block_end] == hi[block_start]:
+            block_end += 1
+        b_lo, b_hi = int(lo[block_start]), int(hi[block_start])
+        if b_hi > b_lo:
+            sims = (source_emb[block_start:block_end] @ target_emb[b_lo:b_hi].T).numpy()
+            for offset, row in enumerate(sims):
+                i = block_start + offset
+                # Max tiền tố trên trạng thái của các hàng trước; trạng thái trước dải gộp thành
+                # một phần tử đầu (-1 = chuỗi bắt đầu từ câu này với điểm 0)
+                head = int(np.argmax(best[:b_lo])) if b_lo > 0 else -1
+                values = np.concatenate(([best[head] if head >= 0 else 0.0], best[b_lo:b_hi]))
+                states = np.concatenate(([head], np.arange(b_lo, b_hi)))
+                running = np.maximum.accumulate(values)
+                improved = values > np.concatenate(([-np.inf], running[:-1]))
+                arg = np.maximum.accumulate(np.where(improved, np.arange(len(values)), 0))
+                prefix_best, prefix_state = running[1:], states[arg][1:]
+                prefix_node = np.where(prefix_state >= 0, node_of[prefix_state], -1)
+
+                candidate = prefix_best + row
+                accepted = np.nonzero((row >= threshold) & (candidate > best[b_lo:b_hi]))[0]
+                for k in accepted:
+                    nodes.append((i, b_lo + int(k), float(row[k]), int(prefix_node[k])))
+                    node_of[b_lo + k] = len(nodes) - 1
+                best[b_lo:b_hi][accepted] = candidate[accepted]
+        block_start = block_end
+
+    matches = np.full(n_source, -1)
+    scores = np.zeros(n_source)
+    if n_target and best.max() > 0:
+        node = node_of[int(np.argmax(best))]
+        while node >= 0:
+            i, j, score, node = nodes[node]
+            matches[i], scores[i] = j, score
+    return matches, scores
+
+
+def align_volume(translated, book, threshold=0.7, page_window=1, window=20, volume=None,
+                 batch_size=64, encoder=None):
+    """Căn các câu đã dịch (DataFrame có Page, Câu tiếng Hán, translation) với câu trong sách.
+
+    encoder: (tokenizer, model, device) của PhoBERT; None thì load mới.
+    Trả về (DataFrame theo schema OUTPUT_COLUMNS, thống kê).
+    """
+    tokenizer, model, device = encoder or load_phobert_model()
+    start = time.perf_counter()
+
+    # Câu nguồn và câu trong sách đều được xử lý theo thứ tự trang
+    has_pages = 'Page' in translated.columns and 'Page' in book.columns
+    source = translated.reset_index(drop=True)
+    source_order = np.argsort(source['Page'].to_numpy(), kind='stable') if 'Page' in source.columns \
+        else np.arange(len(source))
+    if 'Page' in book.columns:
+        book = book.sort_values('Page', kind='stable').reset_index(drop=True)
+
+    source_texts = preprocess_texts(source['translation'].fillna('').astype(str).tolist())
+    target_texts = preprocess_texts(book['sentence'].astype(str).tolist())
+    source_emb = encode_sorted(source_texts, tokenizer, model, device, batch_size)[torch.as_tensor(source_order)]
+    target_emb = encode_sorted(target_texts, tokenizer, model, device, batch_size)
+    encode_time = time.perf_counter() - start
+
+    lo, hi = _bands(
+        source['Page'].to_numpy()[source_order] if has_pages else None,
+        book['Page'].to_numpy() if has_pages else None,
+        len(source), len(book), page_window, window
+    )
+    matches, scores = monotonic_align(source_emb, target_emb, lo, hi, threshold)
+
+    best_match = np.full(len(source), None, dtype=object)
+    aligned_scores = np.zeros(len(source))
+    sentences = book['sentence'].astype(str).to_numpy()
+    for pos, i in enumerate(source_order):
+        if matches[pos] >= 0:
+            best_match[i] = sentences[matches[pos]]
+            aligned_scores[i] = scores[pos]
+
+    output = pd.DataFrame({
+        'Page': source['Page'] if 'Page' in source.columns else None,
+        'Câu tiếng Hán': source['Câu tiếng Hán'],
+        'volumn': volume if volume is not None else source.get('volumn'),
+        'translation': source['translation'],
+        'best_match': best_match,
+    }, columns=OUTPUT_COLUMNS)
+
+    matched = int((matches >= 0).sum())
+    stats = {
+        'source_sentences': len(source),
+        'book_sentences': len(book),
+        'matched': matched,
+        'matched_pct': matched / max(len(source), 1),
+        'mean_score': float(aligned_scores[aligned_scores > 0].mean()) if matched else 0.0,
+        'compared_pairs': int((hi - lo).sum()),
+        'all_pairs': len(source) * len(book),
+        'encode_seconds': encode_time,
+        'total_seconds': time.perf_counter() - start,
+    }
+    return output, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Căn câu tiếng Hán đã dịch với câu tiếng Việt trong sách")
+    parser.add_argument('translated', help="CSV có cột Page, Câu tiếng Hán, translation (và volumn nếu có)")
+    parser.add_argument('book', help="CSV câu trong sách (cột Page + cột câu) hoặc .txt mỗi dòng một câu")
+    parser.add_argument('output', help="File CSV kết quả (Page, Câu tiếng Hán, volumn, translation, best_match)")
+    parser.add_argument('--book-column', default=None, help="Cột chứa câu tiếng Việt trong file sách .csv")
+    parser.add_argument('--volume', default=None, help="Giá trị cột volumn cho kết quả, vd Volume_34")
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--page-window', type=int, default=1, help="Số trang lệch tối đa giữa hai phía")
+    parser.add_argument('--window', type=int, default=20, help="Cửa sổ câu khi sách không có số trang")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=None, help="Số luồng torch (mặc định: tất cả CPU)")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads or os.cpu_count() or 1)
+    translated = pd.read_csv(args.translated)
+    book = read_book(args.book, args.book_column)
+    output, stats = align_volume(
+        translated, book, threshold=args.threshold, page_window=args.page_window,
+        window=args.window, volume=args.volume, batch_size=args.batch_size
+    )
+    output.to_csv(args.output, index=False)
+
+    print(f"Đã căn {stats['matched']}/{stats['source_sentences']} câu ({stats['matched_pct']:.1%}), "
+          f"điểm trung bình {stats['mean_score']:.3f}")
+    print(f"So sánh {stats['compared_pairs']} cặp thay vì {stats['all_pairs']}; "
+          f"encode {stats['encode_seconds']:.1f}s, tổng {stats['total_seconds']:.1f}s -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,25 @@
 Flask API cho hệ thống tìm kiếm Hán-Việt
 """
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from flask_cors import CORS
 import os
 import sys
+import json
+import gzip
+import hashlib
+import contextlib
+import sqlite3
+import threading
 
 # Thêm current directory vào Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Import sau khi đã setup path
-from han_viet_search_system import HanVietVectorStore
+from han_viet_search_system import (
+    HanVietVectorStore, LRUCache, SQLiteCache, MemoryProfiler, SEARCH_DIRECTIONS, read_query_log,
+    preprocess_texts, current_rss
+)
 
 app = Flask(__name__)
 CORS(app)
@@ -20,6 +29,71 @@ CORS(app)
 # Biến global để lưu trữ vectorstore instance
 vectorstore_instance = None
 
+# Cache kết quả dùng chung giữa các worker và các lần khởi động (file SQLite local).
+# QUERY_CACHE_PATH rỗng thì chỉ cache trong bộ nhớ của process
+QUERY_CACHE_PATH = os.environ.get('QUERY_CACHE_PATH', 'query_cache.sqlite')
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 100000))
+# Log cũ (stdout của app hoặc file mỗi dòng một câu) dùng để warm-up cùng query_log trong cache
+QUERY_WARMUP_LOG = os.environ.get('QUERY_WARMUP_LOG')
+QUERY_WARMUP_SIZE = int(os.environ.get('QUERY_WARMUP_SIZE', 200))
+
+# Đo số luồng torch / batch size tốt nhất cho phần cứng hiện tại khi khởi động (AUTOTUNE=0 để tắt);
+# kết quả lưu ở ENCODER_TUNING_PATH và được dùng lại nếu phần cứng không đổi
+AUTOTUNE = os.environ.get('AUTOTUNE', '1') != '0'
+ENCODER_TUNING_PATH = os.environ.get('ENCODER_TUNING_PATH', 'encoder_tuning.json')
+
+# Corpus không đổi giữa hai lần deploy nên response của /api/search được cache theo
+# (phiên bản vectorstore, query đã chuẩn hóa, tham số); ETag đổi khi vectorstore đổi
+SEARCH_CACHE_MAX_AGE = int(os.environ.get('SEARCH_CACHE_MAX_AGE', 3600))
+GZIP_MIN_SIZE = 1024
+response_cache = LRUCache(maxsize=2048)
+
+# MEMORY_PROFILE=1: đo bộ nhớ từng bước load và cấp phát mỗi lần search, xem ở /api/admin/memory
+# (cần header X-Admin-Token trùng ADMIN_TOKEN; không đặt ADMIN_TOKEN thì endpoint bị khóa)
+memory_profiler = MemoryProfiler() if os.environ.get('MEMORY_PROFILE') == '1' else None
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+def profile_step(step):
+    return memory_profiler.track(step) if memory_profiler is not None else contextlib.nullcontext()
+
+def create_query_cache():
+    if QUERY_CACHE_PATH:
+        try:
+            return SQLiteCache(QUERY_CACHE_PATH, maxsize=QUERY_CACHE_SIZE)
+        except sqlite3.Error as e:
+            print(f"⚠️  Cannot open query cache {QUERY_CACHE_PATH}: {str(e)}, using in-memory cache")
+    return LRUCache(maxsize=1024)
+
+def tune_encoders(vectorstore):
+    if not AUTOTUNE:
+        return
+    try:
+        vectorstore.autotune(ENCODER_TUNING_PATH)
+        # API chủ yếu phục vụ từng câu một nên dùng cấu hình của đường query đơn
+        vectorstore.apply_tuning('single')
+    except Exception as e:
+        print(f"⚠️  Encoder autotune failed, keeping defaults: {str(e)}")
+
+def start_cache_warm_up(vectorstore):
+    """Chạy nền các câu hay được hỏi để nạp cache, không chặn app khởi động"""
+    queries = []
+    if isinstance(vectorstore.cache, SQLiteCache):
+        queries.extend(vectorstore.cache.top_queries(QUERY_WARMUP_SIZE))
+    if QUERY_WARMUP_LOG and os.path.exists(QUERY_WARMUP_LOG):
+        queries.extend(read_query_log(QUERY_WARMUP_LOG, QUERY_WARMUP_SIZE))
+    queries = list(dict.fromkeys(queries))[:QUERY_WARMUP_SIZE]
+    if not queries:
+        return
+    
+    def run():
+        try:
+            vectorstore.warm_up(queries)
+            print(f"✅ Query cache warmed up with {len(queries)} queries")
+        except Exception as e:
+            print(f"⚠️  Query cache warm-up failed: {str(e)}")
+    
+    threading.Thread(target=run, daemon=True).start()
+
 def initialize_vectorstore():
     """Khởi tạo vectorstore một lần duy nhất"""
     global vectorstore_instance
@@ -29,11 +103,23 @@ def initialize_vectorstore():
     
     print("=== Initializing Han-Viet Search System ===")
     try:
+        # Vectorstore dạng shard theo quyển: chỉ giữ embeddings của các quyển được dùng
+        shard_dir = os.environ.get('VECTORSTORE_SHARD_DIR')
+        if shard_dir and os.path.exists(os.path.join(shard_dir, 'core.pkl')):
+            preload_volumes = [v.strip() for v in os.environ.get('PRELOAD_VOLUMES', '').split(',') if v.strip()]
+            vectorstore_instance = HanVietVectorStore(None, cache=create_query_cache(), profiler=memory_profiler)
+            vectorstore_instance.load_shards(shard_dir, preload_volumes=preload_volumes)
+            print("✅ Sharded vectorstore loaded successfully!")
+            tune_encoders(vectorstore_instance)
+            start_cache_warm_up(vectorstore_instance)
+            return vectorstore_instance
+        
         model_path = "han_viet_vectorstore.pkl"
         if not os.path.exists(model_path):
             print("Model file not found, loading from Hugging Face Hub...")
             import download_model
-            data = download_model.load_pickle_from_url()
+            with profile_step('download_unpickle'):
+                data = download_model.load_pickle_from_url()
             if data is None:
                 print("❌ Load failed! Model file is required.")
                 return None
@@ -43,23 +129,21 @@ def initialize_vectorstore():
             if not download_model.validate_pickle_file(model_path):
                             print("Invalid model file, loading from URL...")
             os.remove(model_path)
-            data = download_model.load_pickle_from_url()
+            with profile_step('download_unpickle'):
+                data = download_model.load_pickle_from_url()
             if data is None:
                 print("❌ Load failed! Model file is required.")
                 return None
         
-        # Load vectorstore một lần duy nhất với memory optimization
-        print("Loading vectorstore with memory optimization...")
-        import gc
-        gc.collect()  # Clean up memory before loading
-        
-        vectorstore_instance = HanVietVectorStore(None)
+        # Load vectorstore một lần duy nhất. Không gọi gc.collect() trước/sau: các thành phần
+        # được dùng trực tiếp từ data nên không có gì để giải phóng (xem MEMORY_PROFILE=1)
+        print("Loading vectorstore...")
+        vectorstore_instance = HanVietVectorStore(None, cache=create_query_cache(), profiler=memory_profiler)
         # Truyền data đã load sẵn thay vì load lại
         vectorstore_instance.load_vectorstore_from_data(data)
-        
-        # Clean up memory after loading
-        gc.collect()
         print("✅ Vectorstore loaded successfully!")
+        tune_encoders(vectorstore_instance)
+        start_cache_warm_up(vectorstore_instance)
         
         return vectorstore_instance
         
@@ -71,30 +155,136 @@ def initialize_vectorstore():
 # Khởi tạo vectorstore khi app start
 vectorstore_instance = initialize_vectorstore()
 
+def format_results(results):
+    """Chuẩn hóa danh sách kết quả search cho JSON response"""
+    formatted_results = []
+    for result in results:
+        page = result.get('page')
+        volume = result.get('volume')
+        formatted_results.append({
+            'score': round(float(result['score']), 4),
+            'model': result['model'],
+            'stage': result.get('stage'),
+            'han_original': result['han_original'],
+            'translation': result['translation'],
+            'best_match': result['best_match'],
+            'page': int(page) if page is not None and page == page else None,
+            'volume': volume if isinstance(volume, str) else None
+        })
+        if 'matched_field' in result:
+            formatted_results[-1]['matched_field'] = result['matched_field']
+        if 'refs' in result:
+            # Các vị trí (trang, quyển) của những dòng trùng lặp đã được gộp vào kết quả này
+            formatted_results[-1]['refs'] = [
+                {'page': int(ref['page']) if ref['page'] is not None else None, 'volume': ref['volume']}
+                for ref in result['refs']
+            ]
+    return formatted_results
+
+def parse_search_filters(data):
+    """Đọc bộ lọc 'volumes' (list hoặc chuỗi phân cách bởi dấu phẩy) và 'page_range' ([đầu, cuối])"""
+    volumes = data.get('volumes')
+    if isinstance(volumes, str):
+        volumes = [v.strip() for v in volumes.split(',') if v.strip()]
+    if volumes is not None:
+        if not isinstance(volumes, list) or not all(isinstance(v, str) for v in volumes):
+            raise ValueError("'volumes' phải là danh sách tên quyển")
+        volumes = volumes or None
+    
+    page_range = data.get('page_range')
+    if isinstance(page_range, str):
+        page_range = [p.strip() or None for p in page_range.split(',')]
+    if page_range is not None:
+        if not isinstance(page_range, (list, tuple)) or len(page_range) != 2:
+            raise ValueError("'page_range' phải có dạng [trang đầu, trang cuối]")
+        page_range = tuple(None if p is None else int(p) for p in page_range)
+    
+    return volumes, page_range
+
+def normalize_query(query):
+    """Chuẩn hóa query cho khóa cache HTTP (Unicode NFC, gộp khoảng trắng, giữ chữ hoa)"""
+    return preprocess_texts([query], lower=False)[0]
+
+def read_request_data():
+    """Tham số tìm kiếm từ query string (GET) hoặc JSON body (POST)"""
+    if request.method == 'GET':
+        data = request.args.to_dict()
+        return data or None
+    return request.get_json(silent=True)
+
+def cache_key(version, *parts):
+    payload = json.dumps([version, *parts], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:20]
+
+def json_body(payload):
+    """Serialize JSON ổn định (thứ tự khóa cố định) để cùng kết quả luôn ra cùng bytes"""
+    return json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def cached_response(body, etag, allow_gzip=False):
+    """Response 200 kèm ETag/Cache-Control; gzip nếu client chấp nhận và body đủ lớn.
+    Bản nén có ETag riêng (hậu tố -gzip) vì ETag mạnh phải khác nhau giữa các content-coding.
+    """
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={SEARCH_CACHE_MAX_AGE}'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if allow_gzip and len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(f'{etag}-gzip')
+    return response
+
+def not_modified(etag):
+    """304 nếu If-None-Match chứa ETag của bản gốc hoặc bản nén gzip"""
+    for candidate in (etag, f'{etag}-gzip'):
+        if candidate in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(candidate)
+            response.headers['Cache-Control'] = f'public, max-age={SEARCH_CACHE_MAX_AGE}'
+            return response
+    return None
+
 @app.route('/')
 def index():
     """Trang chủ"""
     return render_template('index.html')
 
-@app.route('/api/search', methods=['POST'])
+@app.route('/api/search', methods=['GET', 'POST'])
 def search():
-    """API endpoint để tìm kiếm"""
+    """API endpoint để tìm kiếm (GET ?query=... để trình duyệt/proxy cache được kết quả)"""
     global vectorstore_instance
     
     try:
-        data = request.get_json()
+        data = read_request_data()
         if not data:
             return jsonify({
                 'success': False,
                 'error': 'Dữ liệu không hợp lệ'
             }), 400
             
-        query_han = data.get('query', '').strip()
+        query_han = normalize_query(data.get('query') or '')
+        direction = data.get('direction') or 'han2vi'
+        # compact=1: bỏ 'best_result' (trùng với results[0]) để response gọn hơn
+        compact = str(data.get('compact', '')).lower() in ('1', 'true')
+        
+        if direction not in SEARCH_DIRECTIONS:
+            return jsonify({
+                'success': False,
+                'error': f"'direction' phải là một trong: {', '.join(SEARCH_DIRECTIONS)}"
+            }), 400
         
         if not query_han:
             return jsonify({
                 'success': False,
-                'error': 'Vui lòng nhập câu tiếng Hán'
+                'error': 'Vui lòng nhập câu tiếng Việt' if direction == 'vi2han' else 'Vui lòng nhập câu tiếng Hán'
+            }), 400
+        
+        try:
+            volumes, page_range = parse_search_filters(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({
+                'success': False,
+                'error': f'Bộ lọc không hợp lệ: {str(e)}'
             }), 400
         
         # Kiểm tra xem vectorstore đã được load chưa
@@ -107,8 +297,30 @@ def search():
                     'error': 'Hệ thống chưa sẵn sàng, vui lòng thử lại sau'
                 }), 503
         
+        if direction == 'vi2han' and not vectorstore_instance.has_reverse_index():
+            return jsonify({
+                'success': False,
+                'error': 'Vectorstore chưa có index tiếng Việt để tra ngược Việt -> Hán'
+            }), 503
+        
+        # Đếm mọi lần hỏi (kể cả khi trả từ ETag/response cache) để warm-up theo câu hỏi nhiều nhất
+        if isinstance(vectorstore_instance.cache, SQLiteCache):
+            vectorstore_instance.cache.log_query(query_han, direction)
+        
+        # Lần hỏi lại cùng query được trả từ ETag/response cache, không gọi tới engine
+        key = cache_key(vectorstore_instance.version, query_han, direction,
+                        sorted(volumes) if volumes else None, page_range, compact)
+        etag = f'search-{key}'
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        body = response_cache.get(key)
+        if body is not None:
+            return cached_response(body, etag)
+        
         # Tìm kiếm sử dụng instance đã load sẵn
-        results = vectorstore_instance.search(query_han)
+        results = vectorstore_instance.search(query_han, volumes=volumes, page_range=page_range,
+                                              direction=direction)
         
         if not results:
             return jsonify({
@@ -117,22 +329,20 @@ def search():
             }), 404
         
         # Format kết quả
-        formatted_results = []
-        for result in results:
-            formatted_results.append({
-                'score': round(result['score'], 4),
-                'model': result['model'],
-                'han_original': result['han_original'],
-                'translation': result['translation'],
-                'best_match': result['best_match']
-            })
+        formatted_results = format_results(results)
         
-        return jsonify({
+        payload = {
             'success': True,
             'query': query_han,
-            'results': formatted_results,
-            'best_result': formatted_results[0] if formatted_results else None
-        })
+            'direction': direction,
+            'stage': formatted_results[0]['stage'] if formatted_results else None,
+            'results': formatted_results
+        }
+        if not compact:
+            payload['best_result'] = formatted_results[0] if formatted_results else None
+        body = json_body(payload)
+        response_cache.put(key, body)
+        return cached_response(body, etag)
         
     except Exception as e:
         print(f"Error in search API: {str(e)}")
@@ -141,6 +351,129 @@ def search():
             'error': f'Lỗi: {str(e)}'
         }), 500
 
+@app.route('/api/search-batch', methods=['POST'])
+def search_batch():
+    """API endpoint tìm nhiều câu trong một request: {"queries": [...]}; gzip nếu client hỗ trợ"""
+    global vectorstore_instance
+    
+    data = request.get_json(silent=True) or {}
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+        return jsonify({
+            'success': False,
+            'error': "'queries' phải là danh sách câu"
+        }), 400
+    direction = data.get('direction') or 'han2vi'
+    if direction not in SEARCH_DIRECTIONS:
+        return jsonify({
+            'success': False,
+            'error': f"'direction' phải là một trong: {', '.join(SEARCH_DIRECTIONS)}"
+        }), 400
+    try:
+        volumes, page_range = parse_search_filters(data)
+        top_k = max(1, min(int(data.get('top_k', 1)), 20))
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': f'Bộ lọc không hợp lệ: {str(e)}'
+        }), 400
+    
+    if vectorstore_instance is None:
+        vectorstore_instance = initialize_vectorstore()
+        if vectorstore_instance is None:
+            return jsonify({
+                'success': False,
+                'error': 'Hệ thống chưa sẵn sàng, vui lòng thử lại sau'
+            }), 503
+    if direction == 'vi2han' and not vectorstore_instance.has_reverse_index():
+        return jsonify({
+            'success': False,
+            'error': 'Vectorstore chưa có index tiếng Việt để tra ngược Việt -> Hán'
+        }), 503
+    
+    queries = [normalize_query(q) for q in queries]
+    key = cache_key(vectorstore_instance.version, queries, direction,
+                    sorted(volumes) if volumes else None, page_range, top_k)
+    etag = f'batch-{key}'
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    
+    try:
+        non_empty = [q for q in queries if q]
+        batch_results = iter(vectorstore_instance.search_batch(
+            non_empty, top_k=top_k, volumes=volumes, page_range=page_range, direction=direction
+        )) if non_empty else iter([])
+        items = []
+        for query in queries:
+            formatted_results = format_results(next(batch_results)) if query else []
+            items.append({
+                'query': query,
+                'stage': formatted_results[0]['stage'] if formatted_results else None,
+                'results': formatted_results
+            })
+    except Exception as e:
+        print(f"Error in search batch API: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'Lỗi: {str(e)}'
+        }), 500
+    
+    body = json_body({'success': True, 'direction': direction, 'items': items})
+    return cached_response(body, etag, allow_gzip=True)
+
+@app.route('/api/search-passage', methods=['POST'])
+def search_passage():
+    """API endpoint tìm kiếm cả đoạn văn, trả kết quả từng câu dạng JSON lines (NDJSON)"""
+    global vectorstore_instance
+    
+    data = request.get_json(silent=True) or {}
+    passage = data.get('query', '').strip()
+    if not passage:
+        return jsonify({
+            'success': False,
+            'error': 'Vui lòng nhập đoạn văn tiếng Hán'
+        }), 400
+    
+    try:
+        volumes, page_range = parse_search_filters(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': f'Bộ lọc không hợp lệ: {str(e)}'
+        }), 400
+    
+    if vectorstore_instance is None:
+        print("Vectorstore not initialized, trying to initialize...")
+        vectorstore_instance = initialize_vectorstore()
+        if vectorstore_instance is None:
+            return jsonify({
+                'success': False,
+                'error': 'Hệ thống chưa sẵn sàng, vui lòng thử lại sau'
+            }), 503
+    
+    def generate():
+        total = 0
+        try:
+            for segment in vectorstore_instance.search_passage(passage, volumes=volumes, page_range=page_range):
+                total = segment['total']
+                formatted_results = format_results(segment['results'])
+                yield json.dumps({
+                    'success': bool(formatted_results),
+                    'index': segment['index'],
+                    'total': segment['total'],
+                    'segment': segment['segment'],
+                    'results': formatted_results,
+                    'best_result': formatted_results[0] if formatted_results else None
+                }, ensure_ascii=False) + '\n'
+            yield json.dumps({'done': True, 'total': total}) + '\n'
+        except Exception as e:
+            print(f"Error in search passage API: {str(e)}")
+            yield json.dumps({'done': True, 'error': f'Lỗi: {str(e)}'}, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
+
 @app.route('/api/health')
 def health():
     """Health check"""
@@ -148,7 +481,10 @@ def health():
     status = 'healthy' if vectorstore_instance is not None else 'initializing'
     return jsonify({
         'status': status,
-        'vectorstore_loaded': vectorstore_instance is not None
+        'vectorstore_loaded': vectorstore_instance is not None,
+        'volumes_loaded': vectorstore_instance.loaded_volumes() if vectorstore_instance is not None else [],
+        'reverse_index': vectorstore_instance.has_reverse_index() if vectorstore_instance is not None else False,
+        'tuning': vectorstore_instance.tuning if vectorstore_instance is not None else None
     })
 
 @app.route('/api/init-model')
@@ -174,12 +510,8 @@ def init_model():
 def memory_usage():
     """API endpoint để kiểm tra memory usage"""
     import psutil
-    import gc
-    
-    # Force garbage collection
-    gc.collect()
     
-    # Get memory info
+    # Không ép gc.collect() ở đây: số liệu phải phản ánh bộ nhớ thực khi đang phục vụ
     process = psutil.Process()
     memory_info = process.memory_info()
     
@@ -190,6 +522,19 @@ def memory_usage():
         'vectorstore_loaded': vectorstore_instance is not None
     })
 
+@app.route('/api/admin/memory')
+def admin_memory():
+    """Báo cáo bộ nhớ chi tiết: từng bước load, kích thước từng thành phần, cấp phát mỗi lần search"""
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': 'Không có quyền truy cập'}), 403
+    if memory_profiler is None:
+        return jsonify({
+            'success': False,
+            'error': 'Chưa bật memory profiling (MEMORY_PROFILE=1)',
+            'rss_mb': round(current_rss() / 1024 / 1024, 2)
+        }), 404
+    return jsonify({'success': True, **memory_profiler.report()})
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5008))
     # Tối ưu hóa cho production
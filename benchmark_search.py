@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark cho hệ thống tìm kiếm Hán-Việt
+
+Cách dùng:
+    python benchmark_search.py cascade --queries 200
+    python benchmark_search.py projection --dims 128 256 --method pca
+    python benchmark_search.py memory --queries 100
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import time
+
+import numpy as np
+
+from han_viet_search_system import (
+    HanVietVectorStore, DenseIndex, Projection, MemoryProfiler, EMBEDDING_KEYS, VIETNAMESE_INDEXES
+)
+
+
+def load_vectorstore(model_path="han_viet_vectorstore.pkl", **kwargs):
+    """Load vectorstore từ file .pkl local, nếu không có thì load từ Hugging Face"""
+    vectorstore = HanVietVectorStore(None, **kwargs)
+    if os.path.exists(model_path):
+        vectorstore.load_vectorstore(model_path)
+    else:
+        import download_model
+        profiler = kwargs.get('profiler')
+        with profiler.track('download_unpickle') if profiler is not None else contextlib.nullcontext():
+            data = download_model.load_pickle_from_url()
+        if data is None:
+            raise RuntimeError("Không thể load vectorstore để benchmark")
+        vectorstore.load_vectorstore_from_data(data)
+    return vectorstore
+
+
+def sample_queries(df, n, exact_ratio=0.5, seed=0, column='Câu tiếng Hán'):
+    """Lấy mẫu query từ corpus: một phần giữ nguyên văn, phần còn lại bị cắt bớt ký tự"""
+    rng = random.Random(seed)
+    sentences = df[column].dropna().astype(str).tolist()
+    queries = []
+    for _ in range(n):
+        s = rng.choice(sentences)
+        if rng.random() >= exact_ratio and len(s) > 3:
+            # Bỏ một đoạn ngẫu nhiên để query không còn khớp nguyên văn
+            cut = rng.randrange(1, max(2, len(s) // 4))
+            pos = rng.randrange(0, len(s) - cut)
+            s = s[:pos] + s[pos + cut:]
+        queries.append(s)
+    return queries
+
+
+def _timed_search(vectorstore, query, top_k, cascade):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        results = vectorstore.search(query, top_k=top_k, cascade=cascade)
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def benchmark_cascade(vectorstore, queries, top_k=1):
+    """So sánh cascade với tìm kiếm đầy đủ (cả hai encoder trên toàn corpus)"""
+    stage_counts = {}
+    cascade_times = []
+    full_times = []
+    agree = 0
+
+    for query in queries:
+        cascade_results, cascade_time = _timed_search(vectorstore, query, top_k, True)
+        full_results, full_time = _timed_search(vectorstore, query, top_k, False)
+        cascade_times.append(cascade_time)
+        full_times.append(full_time)
+
+        stage = cascade_results[0]['stage'] if cascade_results else 'none'
+        stage_counts[stage] = stage_counts.get(stage, 0) + 1
+        if cascade_results and full_results and \
+                cascade_results[0]['translation'] == full_results[0]['translation']:
+            agree += 1
+
+    cascade_times = np.array(cascade_times) * 1000
+    full_times = np.array(full_times) * 1000
+    return {
+        'queries': len(queries),
+        'stage_share': {k: v / len(queries) for k, v in sorted(stage_counts.items())},
+        'cascade_mean_ms': float(cascade_times.mean()),
+        'cascade_p50_ms': float(np.median(cascade_times)),
+        'full_mean_ms': float(full_times.mean()),
+        'full_p50_ms': float(np.median(full_times)),
+        'latency_saved_pct': float(100 * (1 - cascade_times.sum() / full_times.sum())),
+        'top1_agreement': agree / len(queries),
+    }
+
+
+def _scan_time(index, query_embeddings, top_k, repeat=3):
+    """Thời gian quét index trung bình mỗi query (ms), không tính thời gian encode"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hits = [index.search(q, top_k) for q in query_embeddings]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(query_embeddings) * 1000, [h[0]['corpus_id'] if h else None for h in hits]
+
+
+def benchmark_projection(vectorstore, n_queries, dims=(128, 256), method='pca', exact_ratio=0.5, top_k=1):
+    """So sánh index giảm chiều với index đủ chiều: tốc độ quét, bộ nhớ và độ trùng top-1.
+
+    Query lấy từ cột tương ứng của corpus (tiếng Hán, hoặc tiếng Việt cho index vi2han)
+    và được encode một lần; projection được học trên embeddings của corpus giống
+    như lúc build (reduce_dimensions).
+    """
+    reports = {}
+    for index_name, key in EMBEDDING_KEYS.items():
+        embeddings = getattr(vectorstore, key)
+        encoder_name = 'phobert' if index_name in VIETNAMESE_INDEXES else index_name
+        if embeddings is None or encoder_name not in vectorstore.encoders:
+            continue
+        column = VIETNAMESE_INDEXES.get(index_name, 'Câu tiếng Hán')
+        queries = sample_queries(vectorstore.df, n_queries, exact_ratio=exact_ratio, column=column)
+        with contextlib.redirect_stdout(io.StringIO()):
+            query_embeddings = vectorstore.encoders[encoder_name].encode(queries)
+
+        full_ms, full_top = _scan_time(DenseIndex(embeddings), query_embeddings, top_k)
+        full_bytes = embeddings.element_size() * embeddings.nelement()
+        for dim in dims:
+            projection = Projection.fit(embeddings, dim, method)
+            reduced = projection.apply(embeddings).to(embeddings.device)
+            reduced_ms, reduced_top = _scan_time(DenseIndex(reduced, projection), query_embeddings, top_k)
+            reduced_bytes = reduced.element_size() * reduced.nelement()
+            reports[f"{index_name} {method}{dim}"] = {
+                'full_scan_ms': full_ms,
+                'reduced_scan_ms': reduced_ms,
+                'scan_speedup': full_ms / reduced_ms if reduced_ms else float('inf'),
+                'full_mb': full_bytes / 1024 / 1024,
+                'reduced_mb': reduced_bytes / 1024 / 1024,
+                'memory_saved_pct': 100 * (1 - reduced_bytes / full_bytes),
+                'top1_agreement': float(np.mean([a == b for a, b in zip(full_top, reduced_top)])),
+            }
+    return reports
+
+
+def benchmark_memory(model_path, queries=100, exact_ratio=0.5):
+    """Load vectorstore với MemoryProfiler rồi chạy các query mẫu, trả về báo cáo bộ nhớ"""
+    profiler = MemoryProfiler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        vectorstore = load_vectorstore(model_path, profiler=profiler)
+    for query in sample_queries(vectorstore.df, queries, exact_ratio=exact_ratio):
+        _timed_search(vectorstore, query, 1, None)
+    report = profiler.report(recent=0)
+    report['search'].pop('recent')
+    return report
+
+
+def _print_report(title, report):
+    print("=" * 50)
+    print(title)
+    print("=" * 50)
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{key}:")
+            for k, v in value.items():
+                if isinstance(v, float):
+                    print(f"  {k}: {v:.2%}" if key.endswith('share') else f"  {k}: {v:.3f}")
+                else:
+                    print(f"  {k}: {v}")
+        elif isinstance(value, float):
+            print(f"{key}: {value:.3f}")
+        else:
+            print(f"{key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hệ thống tìm kiếm Hán-Việt")
+    parser.add_argument('--model-path', default="han_viet_vectorstore.pkl")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    cascade_parser = subparsers.add_parser('cascade', help="Tỷ lệ query được trả lời ở từng tầng và độ trễ tiết kiệm")
+    cascade_parser.add_argument('--queries', type=int, default=200)
+    cascade_parser.add_argument('--exact-ratio', type=float, default=0.5)
+    cascade_parser.add_argument('--threshold', type=float, default=0.7)
+    cascade_parser.add_argument('--margin', type=float, default=0.05)
+    cascade_parser.add_argument('--top-k', type=int, default=1)
+
+    projection_parser = subparsers.add_parser('projection', help="Tốc độ quét, bộ nhớ và độ trùng top-1 khi giảm chiều")
+    projection_parser.add_argument('--queries', type=int, default=200)
+    projection_parser.add_argument('--exact-ratio', type=float, default=0.5)
+    projection_parser.add_argument('--dims', type=int, nargs='+', default=[128, 256])
+    projection_parser.add_argument('--method', choices=Projection.METHODS, default='pca')
+
+    memory_parser = subparsers.add_parser('memory', help="Bộ nhớ từng bước load, từng thành phần và mỗi query")
+    memory_parser.add_argument('--queries', type=int, default=100)
+    memory_parser.add_argument('--exact-ratio', type=float, default=0.5)
+
+    args = parser.parse_args()
+
+    if args.command == 'cascade':
+        vectorstore = load_vectorstore(
+            args.model_path, threshold=args.threshold, ambiguity_margin=args.margin
+        )
+        queries = sample_queries(vectorstore.df, args.queries, exact_ratio=args.exact_ratio)
+        report = benchmark_cascade(vectorstore, queries, top_k=args.top_k)
+        _print_report("CASCADE BENCHMARK", report)
+    elif args.command == 'projection':
+        vectorstore = load_vectorstore(args.model_path)
+        if vectorstore.projections:
+            raise SystemExit("Cần vectorstore đủ chiều để so sánh")
+        reports = benchmark_projection(vectorstore, args.queries, dims=args.dims, method=args.method,
+                                       exact_ratio=args.exact_ratio)
+        for name, report in reports.items():
+            _print_report(f"PROJECTION BENCHMARK: {name}", report)
+    elif args.command == 'memory':
+        report = benchmark_memory(args.model_path, args.queries, exact_ratio=args.exact_ratio)
+        steps = report.pop('load_steps')
+        _print_report("MEMORY REPORT", report)
+        for step, values in steps.items():
+            _print_report(f"LOAD STEP: {step}", values)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ Hệ thống tìm kiếm Hán-Việt sử dụng align.py làm back-end
 """
 
 import torch
+import torch.nn.functional as F
 import pandas as pd
 import numpy as np
 from sentence_transformers import SentenceTransformer, util
@@ -12,6 +13,16 @@ import unicodedata
 import re
 import pickle
 import os
+import json
+import time
+import hashlib
+import sqlite3
+import platform
+import threading
+import tracemalloc
+import contextlib
+import atexit
+from collections import OrderedDict, Counter, deque
 
 # ========== Tiền xử lý ==========
 def preprocess_texts(texts, lower=True, remove_stopwords=False, stopwords=None, norm_unicode='NFC'):
@@ -31,6 +42,26 @@ def preprocess_texts(texts, lower=True, remove_stopwords=False, stopwords=None,
         return s
     return [clean_text(t) for t in texts]
 
+_HAN_PUNCT = '。，、；：？！「」『』（）《》〈〉.,!?;:()[]"\' '
+
+def normalize_han_key(text):
+    """Khóa chuẩn hóa cho câu tiếng Hán: tiền xử lý, bỏ khoảng trắng và dấu câu ở hai đầu"""
+    s = preprocess_texts([text])[0]
+    s = re.sub(r'\s+', '', s)
+    return s.strip(_HAN_PUNCT)
+
+def han_chars(text):
+    """Tập ký tự (không tính dấu câu) của một câu tiếng Hán đã chuẩn hóa"""
+    return {c for c in text if c not in _HAN_PUNCT}
+
+# Chỉ tách ở dấu kết câu: câu trong corpus kết thúc bằng 。！？, còn ；： nằm giữa câu
+_PASSAGE_DELIMITERS = re.compile(r'(?<=[。！？!?\n])')
+
+def split_passage(passage):
+    """Tách đoạn văn tiếng Hán thành các câu theo 。！？ hoặc xuống dòng (giữ dấu ở cuối câu)"""
+    segments = [s.strip() for s in _PASSAGE_DELIMITERS.split(passage)]
+    return [s for s in segments if normalize_han_key(s)]
+
 # ========== PhoBERT ==========
 def load_phobert_model(device=None):
     device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
@@ -71,22 +102,674 @@ def labse_encode(texts, model, batch_size=128):
         embeddings = model.encode(texts, convert_to_tensor=True, batch_size=batch_size, device=model.device)
     return embeddings
 
+# ========== Backends ==========
+# HanVietVectorStore ghép ba loại backend có thể thay thế:
+#   encoder: encode(texts) -> tensor [n, d]
+#   index:   search(query_embedding, top_k, mask=None, volumes=None) -> [{'corpus_id', 'score'}]
+#   cache:   get(key) / put(key, value)
+# Index có thể kèm Projection: embeddings lưu ở số chiều thấp, query được chiếu trước khi quét.
+
+class PhoBERTEncoder:
+    """Encoder PhoBERT (mean pooling)"""
+    name = 'phobert'
+
+    def __init__(self, tokenizer, model, device, batch_size=64):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+
+    def encode(self, texts):
+        return phobert_encode(texts, self.tokenizer, self.model, self.device, batch_size=self.batch_size)
+
+class LaBSEEncoder:
+    """Encoder LaBSE qua SentenceTransformer"""
+    name = 'labse'
+
+    def __init__(self, model, batch_size=128):
+        self.model = model
+        self.batch_size = batch_size
+
+    def encode(self, texts):
+        return labse_encode(texts, self.model, batch_size=self.batch_size)
+
+def tensor_digest(tensor):
+    """SHA1 toàn bộ nội dung tensor; dùng cho phiên bản vectorstore (khóa cache, ETag)"""
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:  # numpy không có bfloat16, băm theo bit
+        tensor = tensor.view(torch.int16)
+    return hashlib.sha1(tensor.numpy().tobytes()).hexdigest()
+
+class Projection:
+    """Giảm số chiều embeddings, học một lần lúc build vectorstore.
+
+    method='pca': chiếu vector đã chuẩn hóa lên dim thành phần chính của corpus.
+    method='truncate': giữ dim chiều đầu của vector đã chuẩn hóa.
+    """
+    METHODS = ('pca', 'truncate')
+
+    def __init__(self, method, dim, mean=None, components=None):
+        if method not in self.METHODS:
+            raise ValueError(f"method phải là một trong {self.METHODS}")
+        self.method = method
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls, embeddings, dim, method='pca'):
+        x = F.normalize(embeddings.float().cpu(), dim=1)
+        if dim >= x.shape[1]:
+            raise ValueError(f"dim phải nhỏ hơn số chiều gốc ({x.shape[1]})")
+        if method == 'truncate':
+            return cls(method, dim)
+        mean = x.mean(dim=0)
+        centered = x - mean
+        # Trị riêng của ma trận hiệp phương sai (d x d) sắp tăng dần, lấy dim vector cuối
+        _, eigenvectors = torch.linalg.eigh(centered.T @ centered)
+        components = eigenvectors[:, -dim:].flip(1).contiguous()
+        return cls(method, dim, mean, components)
+
+    def apply(self, embeddings):
+        x = F.normalize(embeddings.float(), dim=-1)
+        if self.method == 'truncate':
+            return x[..., :self.dim].contiguous()
+        return (x - self.mean.to(x.device)) @ self.components.to(x.device)
+
+    def state(self):
+        return {'method': self.method, 'dim': self.dim, 'mean': self.mean, 'components': self.components}
+
+    def digest(self):
+        parts = [self.method, str(self.dim)] + [tensor_digest(t) for t in (self.mean, self.components) if t is not None]
+        return ':'.join(parts)
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['method'], state['dim'], state.get('mean'), state.get('components'))
+
+class DenseIndex:
+    """Index trên một tensor embeddings nằm trọn trong bộ nhớ"""
+
+    def __init__(self, embeddings, projection=None):
+        self.embeddings = embeddings
+        self.projection = projection
+
+    def search(self, query_embedding, top_k, mask=None, volumes=None):
+        # volumes đã được tính vào mask, index này không chia theo quyển
+        if self.projection is not None:
+            query_embedding = self.projection.apply(query_embedding)
+        query_embedding = query_embedding.unsqueeze(0).to(self.embeddings.dtype)
+        if mask is None:
+            return util.semantic_search(query_embedding, self.embeddings, top_k=top_k)[0]
+
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return []
+        subset = self.embeddings[torch.as_tensor(rows, device=self.embeddings.device)]
+        hits = util.semantic_search(query_embedding, subset, top_k=top_k)[0]
+        for hit in hits:
+            hit['corpus_id'] = int(rows[hit['corpus_id']])
+        return hits
+
+# Tên index -> khóa embeddings trong file .pkl / shard (cũng là tên thuộc tính của HanVietVectorStore)
+EMBEDDING_KEYS = {
+    'phobert': 'han_embeddings_phobert',
+    'labse': 'han_embeddings_labse',
+    'vi_translation': 'vi_embeddings_translation',
+    'vi_best_match': 'vi_embeddings_best_match',
+}
+
+# Index tiếng Việt (chiều vi2han) -> cột được encode; đều dùng encoder PhoBERT
+VIETNAMESE_INDEXES = {
+    'vi_translation': 'translation',
+    'vi_best_match': 'best_match',
+}
+
+SEARCH_DIRECTIONS = ('han2vi', 'vi2han')
+
+class ShardStore:
+    """Các file embeddings theo quyển, mỗi file chỉ được đọc ở lần dùng đầu tiên"""
+
+    def __init__(self, shards, models, digests=None):
+        # shards: {tên quyển: {'rows': chỉ số dòng trong df, 'path': file .pt}}
+        # digests: {mô hình: SHA1 embeddings} do save_shards ghi, dùng cho phiên bản vectorstore
+        self.shards = shards
+        self.models = list(models)
+        self.digests = digests or {}
+        self._embeddings = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        if name not in self._embeddings:
+            with self._lock:
+                if name not in self._embeddings:
+                    print(f"Loading shard {name}...")
+                    data = torch.load(self.shards[name]['path'], map_location='cpu')
+                    self._embeddings[name] = {m: data[EMBEDDING_KEYS[m]] for m in self.models}
+        return self._embeddings[name]
+
+    def loaded(self):
+        return [name for name in self.shards if name in self._embeddings]
+
+class ShardedIndex:
+    """Index của một mô hình trên ShardStore: chỉ quét (và load) shard của các quyển được chọn"""
+
+    def __init__(self, shard_store, model_name, projection=None):
+        self.shard_store = shard_store
+        self.model_name = model_name
+        self.projection = projection
+
+    def search(self, query_embedding, top_k, mask=None, volumes=None):
+        if self.projection is not None:
+            query_embedding = self.projection.apply(query_embedding)
+        query_embedding = query_embedding.unsqueeze(0)
+        shards = self.shard_store.shards
+        names = list(shards) if volumes is None else [v for v in volumes if v in shards]
+
+        hits = []
+        for name in names:
+            rows = shards[name]['rows']
+            local = None if mask is None else np.flatnonzero(mask[rows])
+            if local is not None and len(local) == 0:
+                continue
+            embeddings = self.shard_store.get(name)[self.model_name]
+            if local is not None:
+                embeddings = embeddings[torch.as_tensor(local, device=embeddings.device)]
+                rows = rows[local]
+            query = query_embedding.to(device=embeddings.device, dtype=embeddings.dtype)
+            for hit in util.semantic_search(query, embeddings, top_k=top_k)[0]:
+                hit['corpus_id'] = int(rows[hit['corpus_id']])
+                hits.append(hit)
+        return sorted(hits, key=lambda x: -x['score'])[:top_k]
+
+class LRUCache:
+    """Cache kết quả trong bộ nhớ, giới hạn số phần tử, an toàn khi dùng nhiều thread"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SQLiteCache:
+    """Cache bền vững trong file SQLite, dùng chung giữa các process/worker trên cùng máy.
+
+    Cùng giao diện get/put với LRUCache. Khóa được lưu dạng repr (tuple gồm chuỗi/số),
+    giá trị dạng pickle. Khi vượt maxsize, các khóa lâu không được dùng nhất bị xóa.
+    Thời điểm truy cập chỉ được ghi lại khi giá trị cũ đã quá touch_interval giây (LRU xấp xỉ),
+    nên phần lớn lần đọc trúng cache không mở transaction ghi.
+    Bảng query_log đếm số lần mỗi câu được hỏi để warm-up cache khi khởi động; số lần hỏi
+    được gộp trong bộ nhớ và ghi xuống sau mỗi log_interval giây (và khi process thoát).
+    """
+
+    def __init__(self, path, maxsize=100000, touch_interval=300, log_interval=30):
+        self.path = path
+        self.maxsize = maxsize
+        self.touch_interval = touch_interval
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._pending_queries = Counter()
+        self._last_log_flush = time.time()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, accessed REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS query_log '
+                           '(query TEXT, direction TEXT, hits INTEGER, last_seen REAL, PRIMARY KEY (query, direction))')
+        self._size = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        atexit.register(self.flush_query_log)
+
+    def get(self, key):
+        key = repr(key)
+        with self._lock:
+            row = self._conn.execute('SELECT value, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.touch_interval:
+                self._conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO cache (key, value, accessed) VALUES (?, ?, ?)',
+                               (repr(key), data, time.time()))
+            self._size += 1
+            if self._size > self.maxsize:
+                self._evict()
+
+    def _evict(self):
+        # Xóa thêm 10% để không phải dọn ở mỗi lần put
+        self._size = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        excess = self._size - self.maxsize
+        if excess > 0:
+            excess += self.maxsize // 10
+            self._conn.execute('DELETE FROM cache WHERE key IN '
+                               '(SELECT key FROM cache ORDER BY accessed LIMIT ?)', (excess,))
+            self._conn.execute('DELETE FROM query_log WHERE rowid IN '
+                               '(SELECT rowid FROM query_log ORDER BY hits DESC, last_seen DESC LIMIT -1 OFFSET ?)',
+                               (self.maxsize,))
+            self._size = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+            self._size = 0
+
+    def log_query(self, query, direction='han2vi'):
+        """Đếm một lần hỏi; chỉ ghi xuống SQLite khi đã quá log_interval giây từ lần ghi trước"""
+        with self._lock:
+            self._pending_queries[(query, direction)] += 1
+        if time.time() - self._last_log_flush >= self.log_interval:
+            self.flush_query_log()
+
+    def flush_query_log(self):
+        with self._lock:
+            pending = self._pending_queries
+            self._pending_queries = Counter()
+            self._last_log_flush = time.time()
+            if not pending:
+                return
+            now = time.time()
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT INTO query_log (query, direction, hits, last_seen) VALUES (?, ?, ?, ?) '
+                                   'ON CONFLICT (query, direction) DO UPDATE SET hits = hits + excluded.hits, '
+                                   'last_seen = excluded.last_seen',
+                                   [(query, direction, hits, now) for (query, direction), hits in pending.items()])
+            self._conn.execute('COMMIT')
+
+    def top_queries(self, limit=200):
+        """Các câu được hỏi nhiều nhất: [(query, direction)]"""
+        self.flush_query_log()
+        with self._lock:
+            return self._conn.execute('SELECT query, direction FROM query_log ORDER BY hits DESC, last_seen DESC LIMIT ?',
+                                      (limit,)).fetchall()
+
+def _parse_log_line(line):
+    """(query, direction) nếu dòng là bản ghi JSON có 'query' hoặc dòng "Searching for: ..." của app, ngược lại None"""
+    if line.startswith('{'):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        if isinstance(record, dict) and record.get('query'):
+            return record['query'], record.get('direction') or 'han2vi'
+        return None
+    if 'Searching for: ' in line:
+        return line.split('Searching for: ', 1)[1], 'han2vi'
+    return None
+
+def read_query_log(log_path, limit=200):
+    """Đọc các câu đã được hỏi từ file log. Mỗi file chỉ theo một định dạng:
+    nếu có dòng JSON có 'query' hoặc dòng log "Searching for: ..." của app thì chỉ lấy các dòng đó
+    (bỏ qua cảnh báo, access log... in lẫn trong stdout); không có thì coi mỗi dòng là một câu.
+    Trả về [(query, direction)] theo thứ tự hỏi nhiều nhất.
+    """
+    with open(log_path, encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    parsed = [_parse_log_line(line) for line in lines]
+    if any(parsed):
+        entries = [entry for entry in parsed if entry]
+    else:
+        entries = [(line, 'han2vi') for line in lines]
+
+    counts = Counter()
+    for query, direction in entries:
+        query = query.strip()
+        if query and direction in SEARCH_DIRECTIONS:
+            counts[(query, direction)] += 1
+    return [item for item, _ in counts.most_common(limit)]
+
+# ========== Autotune ==========
+def available_cpus():
+    """Số CPU process được phép dùng (tính cả giới hạn affinity của container)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _thread_candidates(max_threads):
+    candidates = [1]
+    while candidates[-1] * 2 <= max_threads:
+        candidates.append(candidates[-1] * 2)
+    if candidates[-1] != max_threads:
+        candidates.append(max_threads)
+    return candidates
+
+def _time_encode(encoder, texts, repeat=1):
+    """Thời gian encode ngắn nhất sau repeat lần (giây)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encoder.encode(texts)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# ========== Memory profiling ==========
+_MB = 1024 * 1024
+
+def current_rss():
+    """RSS hiện tại của process (bytes)"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def object_size(obj):
+    """Kích thước dữ liệu chính của một thành phần vectorstore (bytes), None nếu không đo được"""
+    if obj is None:
+        return None
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, torch.nn.Module):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(t.element_size() * t.nelement() for t in tensors)
+    return None
+
+class MemoryProfiler:
+    """Đo bộ nhớ theo từng bước load (tracemalloc + RSS) và lượng cấp phát của mỗi lần search.
+
+    tracemalloc chỉ thấy cấp phát của Python (DataFrame, dict, list...); bộ nhớ tensor/mô hình
+    do torch cấp phát nằm ngoài tracemalloc nên được tính qua chênh lệch RSS và kích thước
+    tensor. Bật tracemalloc làm chậm các cấp phát Python nên chỉ dùng khi cần đo.
+    """
+
+    def __init__(self, max_queries=1000):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.steps = OrderedDict()
+        self.sizes = {}
+        self.queries = deque(maxlen=max_queries)
+        self._lock = threading.Lock()
+        self._baseline_rss = current_rss()
+
+    @contextlib.contextmanager
+    def track(self, step):
+        rss_before = current_rss()
+        traced_before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            traced_after, traced_peak = tracemalloc.get_traced_memory()
+            rss_after = current_rss()
+            self.steps[step] = {
+                'seconds': round(time.perf_counter() - start, 3),
+                'rss_delta_mb': round((rss_after - rss_before) / _MB, 2),
+                'python_retained_mb': round((traced_after - traced_before) / _MB, 2),
+                'python_peak_mb': round((traced_peak - traced_before) / _MB, 2),
+            }
+
+    def record_sizes(self, vectorstore):
+        """Kích thước ổn định của từng thành phần sau khi load"""
+        components = {'df': vectorstore.df, 'phobert_model': vectorstore.phobert_model,
+                      'labse_model': vectorstore.labse_model}
+        for key in EMBEDDING_KEYS.values():
+            components[key] = getattr(vectorstore, key)
+        self.sizes = {name: round(size / _MB, 2) for name, size in
+                      ((name, object_size(obj)) for name, obj in components.items()) if size is not None}
+
+    @contextlib.contextmanager
+    def track_query(self, n_queries):
+        # Đỉnh tracemalloc là chung cho cả process, nên với nhiều request đồng thời số liệu chỉ là xấp xỉ
+        with self._lock:
+            traced_before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        rss_before = current_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            traced_after, traced_peak = tracemalloc.get_traced_memory()
+            self.queries.append({
+                'queries': n_queries,
+                'ms': round((time.perf_counter() - start) * 1000, 2),
+                'allocated_kb': round((traced_peak - traced_before) / 1024, 1),
+                'retained_kb': round((traced_after - traced_before) / 1024, 1),
+                'rss_delta_kb': round((current_rss() - rss_before) / 1024, 1),
+            })
+
+    def report(self, recent=20):
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        queries = list(self.queries)
+        allocated = [q['allocated_kb'] / q['queries'] for q in queries if q['queries']]
+        try:
+            import resource
+            # ru_maxrss tính bằng KB trên Linux
+            peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+        except ImportError:
+            peak_rss_mb = None
+        return {
+            'rss_mb': round(current_rss() / _MB, 2),
+            'peak_rss_mb': peak_rss_mb,
+            'baseline_rss_mb': round(self._baseline_rss / _MB, 2),
+            'python_traced_mb': round(traced / _MB, 2),
+            'load_steps': dict(self.steps),
+            'component_mb': dict(self.sizes),
+            'search': {
+                'calls': len(queries),
+                'mean_allocated_kb_per_query': round(float(np.mean(allocated)), 1) if allocated else None,
+                'max_allocated_kb_per_query': round(float(np.max(allocated)), 1) if allocated else None,
+                'recent': queries[-recent:],
+            },
+        }
+
 # ========== VectorStore Class ==========
+UNKNOWN_VOLUME = 'Unknown'
+
 class HanVietVectorStore:
-    def __init__(self, data_path):
+    def __init__(self, data_path=None, threshold=0.7, ambiguity_margin=0.05, min_char_overlap=0.5,
+                 max_candidates=512, primary_model='labse', use_cascade=True, cache=None, verbose=True,
+                 profiler=None):
         self.data_path = data_path
         self.df = None
         self.han_embeddings_phobert = None
         self.han_embeddings_labse = None
+        # Index PhoBERT trên các cột tiếng Việt cho chiều tra ngược Việt -> Hán
+        self.vi_embeddings_translation = None
+        self.vi_embeddings_best_match = None
+        # Projection giảm chiều theo từng index (rỗng = dùng đủ số chiều)
+        self.projections = {}
         self.phobert_tokenizer = None
         self.phobert_model = None
         self.labse_model = None
         self.device = None
-        
+
+        # Cấu hình cascade: exact -> lọc ký tự -> encoder chính -> encoder phụ (khi mơ hồ)
+        self.threshold = threshold
+        self.ambiguity_margin = ambiguity_margin
+        self.min_char_overlap = min_char_overlap
+        self.max_candidates = max_candidates
+        self.primary_model = primary_model
+        self.use_cascade = use_cascade
+
+        # Backend encoder/index theo tên mô hình, tạo lại mỗi khi load; có thể
+        # thay bằng register_backend. cache=None nghĩa là không cache kết quả
+        self.encoders = {}
+        self.indexes = {}
+        # Index đăng ký bằng register_backend (bị thay khi embeddings của corpus đổi)
+        self._custom_indexes = set()
+        self.cache = cache
+        self.verbose = verbose
+        # Phiên bản dữ liệu + backend, là một phần của khóa cache (cache bền vững dùng chung
+        # giữa các lần khởi động nên không xóa cache khi load lại mà đổi phiên bản)
+        self.version = None
+        self._backend_revision = 0
+        # Cấu hình số luồng torch / batch size của encoder do autotune() chọn
+        self.tuning = None
+        # MemoryProfiler (tùy chọn): đo bộ nhớ khi load và cấp phát của mỗi lần search
+        self.profiler = profiler
+
+        # Chỉ mục từ vựng, tạo lười khi search lần đầu
+        self._exact_index = None
+        self._char_postings = None
+
+        # Shard theo quyển (cột 'volumn'). Khi load từ thư mục shard, embeddings
+        # của từng quyển chỉ được đọc vào bộ nhớ khi có query cần quét quyển đó
+        self.shards = None
+        self.shard_store = None
+        self._row_volumes = None
+        self._row_pages = None
+        # Sau collapse_duplicates mỗi dòng có cột 'refs' [(trang, quyển)]; lọc trang theo mọi ref
+        self._ref_rows = None
+        self._ref_pages = None
+
+    @property
+    def is_loaded(self):
+        return self.df is not None
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _track(self, step):
+        return self.profiler.track(step) if self.profiler is not None else contextlib.nullcontext()
+
+    def _reset_indexes(self):
+        self._exact_index = None
+        self._char_postings = None
+        self.shards = None
+        self.shard_store = None
+        self._row_volumes = None
+        self._row_pages = None
+        self._ref_rows = None
+        self._ref_pages = None
+        self._backend_revision = 0
+        self.version = None
+
+    def _compute_version(self):
+        """Dấu vân tay của corpus, embeddings và projection; giống nhau giữa các process load cùng dữ liệu"""
+        digest = hashlib.sha1()
+        if self.df is not None:
+            digest.update(pd.util.hash_pandas_object(self.df, index=True).values.tobytes())
+        for index_name, key in EMBEDDING_KEYS.items():
+            embeddings = getattr(self, key)
+            if embeddings is not None:
+                digest.update(f"{index_name}:{tuple(embeddings.shape)}:{tensor_digest(embeddings)}".encode())
+            elif self.shard_store is not None and index_name in self.shard_store.models:
+                content = self.shard_store.digests.get(index_name)
+                if content is None:
+                    # core.pkl cũ không có digest: dùng kích thước/mtime của các file shard
+                    content = [(name, os.path.getsize(shard['path']), os.stat(shard['path']).st_mtime_ns)
+                               for name, shard in sorted(self.shards.items())]
+                digest.update(f"{index_name}:shards:{sorted(self.shards)}:{content}".encode())
+        for index_name, projection in sorted(self.projections.items()):
+            digest.update(f"{index_name}:{projection.digest()}".encode())
+        if self._backend_revision:
+            digest.update(f"revision:{id(self)}:{self._backend_revision}".encode())
+        return digest.hexdigest()[:16]
+
+    def _build_backends(self):
+        """Tạo encoder/index mặc định từ mô hình và embeddings đã load (khi load vectorstore)"""
+        self.encoders = {}
+        self.indexes = {}
+        self._custom_indexes = set()
+        if self.phobert_tokenizer is not None and self.phobert_model is not None:
+            self.encoders['phobert'] = PhoBERTEncoder(self.phobert_tokenizer, self.phobert_model, self.device)
+        if self.labse_model is not None:
+            self.encoders['labse'] = LaBSEEncoder(self.labse_model)
+        self._apply_batch_sizes()
+        self._rebuild_indexes()
+
+    def _apply_batch_sizes(self):
+        """Đặt batch size do autotune chọn cho các encoder hiện có (kể cả encoder đăng ký riêng)"""
+        if not self.tuning:
+            return
+        for name, batch_size in self.tuning['batch']['batch_size'].items():
+            if name in self.encoders and hasattr(self.encoders[name], 'batch_size'):
+                self.encoders[name].batch_size = batch_size
+
+    def _rebuild_indexes(self):
+        """Tạo lại index từ embeddings hiện tại sau khi embeddings đổi; encoder được giữ nguyên.
+        Index đăng ký bằng register_backend được tính trên embeddings cũ nên bị thay."""
+        for index_name, key in EMBEDDING_KEYS.items():
+            embeddings = getattr(self, key)
+            projection = self.projections.get(index_name)
+            if index_name in self._custom_indexes:
+                print(f"⚠️  Custom index '{index_name}' replaced after embeddings changed")
+                self._custom_indexes.discard(index_name)
+            if embeddings is not None:
+                self.indexes[index_name] = DenseIndex(embeddings, projection)
+            elif self.shard_store is not None and index_name in self.shard_store.models:
+                self.indexes[index_name] = ShardedIndex(self.shard_store, index_name, projection)
+            else:
+                self.indexes.pop(index_name, None)
+        self.version = self._compute_version()
+
+    def register_backend(self, model_name, encoder=None, index=None):
+        """Thay encoder và/hoặc index của một mô hình (ví dụ index nén, encoder khác)"""
+        if encoder is not None:
+            self.encoders[model_name] = encoder
+        if index is not None:
+            self.indexes[model_name] = index
+            self._custom_indexes.add(model_name)
+        # Backend tùy biến chỉ có trong process này: tách khóa cache khỏi các process khác
+        self._backend_revision += 1
+        self.version = self._compute_version()
+
+    def _ensure_indexes(self):
+        if self._row_volumes is None:
+            self._row_volumes = self.df['volumn'].fillna(UNKNOWN_VOLUME).astype(str).to_numpy()
+            self._row_pages = pd.to_numeric(self.df['Page'], errors='coerce').to_numpy()
+            if 'refs' in self.df.columns:
+                refs = self.df['refs'].tolist()
+                self._ref_rows = np.repeat(np.arange(len(refs)), [len(r) for r in refs])
+                self._ref_pages = np.array([np.nan if page is None else page for r in refs for page, _ in r],
+                                           dtype=float)
+        if self.shards is None:
+            self._build_shards()
+        if self._exact_index is None:
+            with self._track('lexical_index'):
+                self._build_lexical_index()
+
+    def _build_shards(self):
+        """Chia các dòng của corpus theo quyển; embeddings vẫn nằm trong tensor chung"""
+        self.shards = {}
+        for name in sorted(set(self._row_volumes)):
+            self.shards[name] = {'rows': np.flatnonzero(self._row_volumes == name)}
+
+    def _build_lexical_index(self):
+        """Tạo chỉ mục exact-match và chỉ mục ngược ký tự -> dòng"""
+        exact_index = {}
+        postings = {}
+        for idx, han in enumerate(self.df['Câu tiếng Hán'].astype(str).tolist()):
+            key = normalize_han_key(han)
+            exact_index.setdefault(key, []).append(idx)
+            for c in han_chars(key):
+                postings.setdefault(c, []).append(idx)
+        self._exact_index = exact_index
+        self._char_postings = {c: np.asarray(rows, dtype=np.int64) for c, rows in postings.items()}
+
     def load_data(self):
         """Load data từ CSV file"""
         print("Loading data...")
         self.df = pd.read_csv(self.data_path)
+        self._reset_indexes()
         print(f"Loaded {len(self.df)} records")
         return self.df
     
@@ -115,7 +798,37 @@ class HanVietVectorStore:
         print("Encoding with LaBSE...")
         self.han_embeddings_labse = labse_encode(han_sentences, self.labse_model)
         
+        self.create_vietnamese_embeddings()
         print("Embeddings created successfully!")
+
+    def create_vietnamese_embeddings(self):
+        """Tạo index PhoBERT cho các cột tiếng Việt (translation, best_match) để tra ngược Việt -> Hán"""
+        for index_name, column in VIETNAMESE_INDEXES.items():
+            print(f"Encoding column '{column}' with PhoBERT...")
+            sentences = preprocess_texts(self.df[column].fillna('').astype(str).tolist())
+            setattr(self, EMBEDDING_KEYS[index_name], phobert_encode(
+                sentences, self.phobert_tokenizer, self.phobert_model, self.device
+            ))
+            self.projections.pop(index_name, None)
+        self._rebuild_indexes()
+
+    def reduce_dimensions(self, dim=256, method='pca'):
+        """Giảm số chiều các embeddings đã có (PCA hoặc cắt bớt vector chuẩn hóa).
+
+        Projection được học trên embeddings của corpus, lưu cùng vectorstore và áp
+        dụng cho query sau khi encode. Chỉ gọi trên embeddings đủ chiều.
+        """
+        for index_name, key in EMBEDDING_KEYS.items():
+            embeddings = getattr(self, key)
+            if embeddings is None:
+                continue
+            if index_name in self.projections:
+                raise RuntimeError(f"Index '{index_name}' đã được giảm chiều")
+            print(f"Reducing {index_name} embeddings: {embeddings.shape[1]} -> {dim} ({method})...")
+            projection = Projection.fit(embeddings, dim, method)
+            setattr(self, key, projection.apply(embeddings).to(embeddings.device))
+            self.projections[index_name] = projection
+        self._rebuild_indexes()
         
     def save_vectorstore(self, save_path="han_viet_vectorstore.pkl"):
         """Lưu vectorstore"""
@@ -124,6 +837,9 @@ class HanVietVectorStore:
             'df': self.df,
             'han_embeddings_phobert': self.han_embeddings_phobert,
             'han_embeddings_labse': self.han_embeddings_labse,
+            'vi_embeddings_translation': self.vi_embeddings_translation,
+            'vi_embeddings_best_match': self.vi_embeddings_best_match,
+            'projections': {name: p.state() for name, p in self.projections.items()},
             'phobert_tokenizer': self.phobert_tokenizer,
             'phobert_model': self.phobert_model,
             'labse_model': self.labse_model,
@@ -141,14 +857,15 @@ class HanVietVectorStore:
             if load_path.startswith("http") or "huggingface" in load_path:
                 print("Loading from Hugging Face URL...")
                 import download_model
-                vectorstore_data = download_model.load_pickle_from_url()
+                with self._track('download_unpickle'):
+                    vectorstore_data = download_model.load_pickle_from_url()
                 if vectorstore_data is None:
                     print("Failed to load from URL, trying local file...")
                     with open(load_path, 'rb') as f:
                         vectorstore_data = pickle.load(f)
             else:
                 # Load từ local file
-                with open(load_path, 'rb') as f:
+                with self._track('unpickle'), open(load_path, 'rb') as f:
                     vectorstore_data = pickle.load(f)
                     
         except (ModuleNotFoundError, AttributeError) as e:
@@ -162,52 +879,39 @@ class HanVietVectorStore:
             print(f"❌ Error loading vectorstore: {str(e)}")
             raise
             
-        # Memory optimization: Load data step by step
-        print("Loading DataFrame...")
-        self.df = vectorstore_data['df']
-        import gc
-        gc.collect()
-        
-        print("Loading PhoBERT embeddings...")
-        self.han_embeddings_phobert = vectorstore_data.get('han_embeddings_phobert')
-        gc.collect()
-        
-        print("Loading LaBSE embeddings...")
-        self.han_embeddings_labse = vectorstore_data.get('han_embeddings_labse')
-        gc.collect()
-        
-        print("Loading models...")
-        self.phobert_tokenizer = vectorstore_data.get('phobert_tokenizer')
-        self.phobert_model = vectorstore_data.get('phobert_model')
-        self.labse_model = vectorstore_data.get('labse_model')
-        self.device = vectorstore_data.get('device', 'cpu')
-        
-        # Force CPU usage for memory optimization
-        if self.phobert_model is not None:
-            self.phobert_model = self.phobert_model.cpu()
-        if self.labse_model is not None:
-            self.labse_model = self.labse_model.cpu()
-        
-        gc.collect()
+        self._load_components(vectorstore_data)
         print("Vectorstore loaded successfully!")
         
     def load_vectorstore_from_data(self, vectorstore_data):
         """Load vectorstore từ data đã load sẵn (tránh load lại từ URL)"""
         print("Loading vectorstore from pre-loaded data...")
         
-        # Memory optimization: Load data step by step
+        self._load_components(vectorstore_data)
+        print("Vectorstore loaded successfully from data!")
+
+    def _load_components(self, vectorstore_data):
+        """Gán các thành phần từ dict đã unpickle.
+
+        Các thành phần chỉ được gán lại (không sao chép) và vectorstore_data vẫn giữ
+        tham chiếu tới chúng, nên không gọi gc.collect() giữa các bước: không có gì
+        được giải phóng. Dùng profiler (benchmark_search.py memory) để xem kích thước
+        thực của từng thành phần.
+        """
         print("Loading DataFrame...")
         self.df = vectorstore_data['df']
-        import gc
-        gc.collect()
+        self._reset_indexes()
         
         print("Loading PhoBERT embeddings...")
         self.han_embeddings_phobert = vectorstore_data.get('han_embeddings_phobert')
-        gc.collect()
         
         print("Loading LaBSE embeddings...")
         self.han_embeddings_labse = vectorstore_data.get('han_embeddings_labse')
-        gc.collect()
+        
+        # File .pkl cũ chưa có index tiếng Việt thì hai giá trị này là None
+        self.vi_embeddings_translation = vectorstore_data.get('vi_embeddings_translation')
+        self.vi_embeddings_best_match = vectorstore_data.get('vi_embeddings_best_match')
+        self.projections = {name: Projection.from_state(state)
+                            for name, state in (vectorstore_data.get('projections') or {}).items()}
         
         print("Loading models...")
         self.phobert_tokenizer = vectorstore_data.get('phobert_tokenizer')
@@ -215,89 +919,655 @@ class HanVietVectorStore:
         self.labse_model = vectorstore_data.get('labse_model')
         self.device = vectorstore_data.get('device', 'cpu')
         
-        # Force CPU usage for memory optimization
+        # Mô hình đã lưu trên GPU được chuyển về CPU (bản GPU được giải phóng khi hết tham chiếu)
+        with self._track('models_to_cpu'):
+            if self.phobert_model is not None:
+                self.phobert_model = self.phobert_model.cpu()
+            if self.labse_model is not None:
+                self.labse_model = self.labse_model.cpu()
+        self._build_backends()
+        if self.profiler is not None:
+            self.profiler.record_sizes(self)
+
+    def load_vectorstore_from_url(self):
+        """Load vectorstore trực tiếp từ Hugging Face Hub"""
+        import download_model
+        with self._track('download_unpickle'):
+            vectorstore_data = download_model.load_pickle_from_url()
+        if vectorstore_data is None:
+            raise RuntimeError("Không thể load vectore store (file .pkl) từ Hugging Face cá nhân!")
+        self.load_vectorstore_from_data(vectorstore_data)
+        
+    def save_shards(self, shard_dir):
+        """Lưu vectorstore dạng shard: core.pkl (df + mô hình) và một file embeddings cho mỗi quyển"""
+        self._ensure_indexes()
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_models = [m for m, key in EMBEDDING_KEYS.items() if getattr(self, key) is not None]
+
+        manifest = {}
+        for i, (name, shard) in enumerate(self.shards.items()):
+            file_name = f"shard_{i:03d}.pt"
+            print(f"Saving shard {name} ({len(shard['rows'])} rows) to {file_name}...")
+            shard_data = {}
+            for m in shard_models:
+                embeddings = getattr(self, EMBEDDING_KEYS[m])
+                rows = torch.as_tensor(shard['rows'], device=embeddings.device)
+                shard_data[EMBEDDING_KEYS[m]] = embeddings[rows].cpu().clone()
+            torch.save(shard_data, os.path.join(shard_dir, file_name))
+            manifest[name] = {'rows': shard['rows'], 'file': file_name}
+
+        core = {
+            'df': self.df,
+            'shards': manifest,
+            'shard_models': shard_models,
+            'embedding_digests': {m: tensor_digest(getattr(self, EMBEDDING_KEYS[m])) for m in shard_models},
+            'projections': {name: p.state() for name, p in self.projections.items()},
+            'phobert_tokenizer': self.phobert_tokenizer,
+            'phobert_model': self.phobert_model,
+            'labse_model': self.labse_model,
+            'device': self.device
+        }
+        with open(os.path.join(shard_dir, 'core.pkl'), 'wb') as f:
+            pickle.dump(core, f)
+        print("Shards saved successfully!")
+
+    def load_shards(self, shard_dir, preload_volumes=None):
+        """Load vectorstore dạng shard; embeddings của mỗi quyển chỉ được đọc khi cần.
+
+        preload_volumes: các quyển cần đọc ngay lúc khởi động (ví dụ các quyển
+        instance này phục vụ), các quyển còn lại load lười ở query đầu tiên.
+        """
+        print(f"Loading sharded vectorstore from {shard_dir}...")
+        with self._track('unpickle_core'), open(os.path.join(shard_dir, 'core.pkl'), 'rb') as f:
+            core = pickle.load(f)
+
+        self.df = core['df']
+        self._reset_indexes()
+        for key in EMBEDDING_KEYS.values():
+            setattr(self, key, None)
+        self.projections = {name: Projection.from_state(state)
+                            for name, state in (core.get('projections') or {}).items()}
+        self.phobert_tokenizer = core.get('phobert_tokenizer')
+        self.phobert_model = core.get('phobert_model')
+        self.labse_model = core.get('labse_model')
+        self.device = core.get('device', 'cpu')
         if self.phobert_model is not None:
             self.phobert_model = self.phobert_model.cpu()
         if self.labse_model is not None:
             self.labse_model = self.labse_model.cpu()
+
+        self.shards = {
+            name: {
+                'rows': entry['rows'],
+                'path': os.path.join(shard_dir, entry['file'])
+            }
+            for name, entry in core['shards'].items()
+        }
+        self.shard_store = ShardStore(self.shards, core['shard_models'], core.get('embedding_digests'))
+        self._build_backends()
+        with self._track('preload_shards'):
+            for name in preload_volumes or []:
+                if name in self.shards:
+                    self.shard_store.get(name)
+        if self.profiler is not None:
+            self.profiler.record_sizes(self)
+        print(f"Sharded vectorstore loaded: {len(self.shards)} volumes, {len(self.loaded_volumes())} resident")
         
-        gc.collect()
-        print("Vectorstore loaded successfully from data!")
-        
-    def search(self, query_han, top_k=1):
-        """Tìm kiếm câu tiếng Việt tương ứng"""
-        print(f"Searching for: {query_han}")
-        
-        # Kiểm tra xem có embeddings không
-        if self.han_embeddings_phobert is None and self.han_embeddings_labse is None:
-            print("⚠️  No embeddings available, using simple text search...")
-            return self.simple_search(query_han, top_k)
-        
-        # Tiền xử lý query
-        query_processed = preprocess_texts([query_han])[0]
-        
-        # Encode query và tìm kiếm
-        all_hits = []
-        
-        # PhoBERT search
-        if self.han_embeddings_phobert is not None and self.phobert_tokenizer is not None:
-            try:
-                query_embedding_phobert = phobert_encode(
-                    [query_processed], self.phobert_tokenizer, self.phobert_model, self.device
-                )
-                hits_phobert = util.semantic_search(
-                    query_embedding_phobert, self.han_embeddings_phobert, top_k=top_k
-                )[0]
-                for hit in hits_phobert:
-                    hit['model'] = 'phobert'
-                    all_hits.append(hit)
-            except Exception as e:
-                print(f"PhoBERT search failed: {str(e)}")
-        
-        # LaBSE search
-        if self.han_embeddings_labse is not None and self.labse_model is not None:
-            try:
-                query_embedding_labse = labse_encode([query_processed], self.labse_model)
-                hits_labse = util.semantic_search(
-                    query_embedding_labse, self.han_embeddings_labse, top_k=top_k
-                )[0]
-                for hit in hits_labse:
-                    hit['model'] = 'labse'
-                    all_hits.append(hit)
-            except Exception as e:
-                print(f"LaBSE search failed: {str(e)}")
-        
-        # Nếu không có kết quả từ embeddings, dùng simple search
-        if not all_hits:
-            print("⚠️  No semantic search results, using simple text search...")
-            return self.simple_search(query_han, top_k)
-        
-        # Sort by score
-        all_hits = sorted(all_hits, key=lambda x: -x['score'])[:top_k]
-        
-        # Get results
-        results = []
-        for hit in all_hits:
+    def _has_embeddings(self, model_name):
+        return model_name in self.encoders and model_name in self.indexes
+
+    def _hardware_signature(self):
+        return {
+            'cpus': available_cpus(),
+            'device': str(self.device),
+            'machine': platform.machine(),
+            'torch': torch.__version__,
+            'encoders': sorted(self.encoders),
+        }
+
+    def autotune(self, path=None, sample_size=64, batch_sizes=(8, 16, 32, 64, 128), force=False):
+        """Đo thời gian encode câu mẫu trong corpus với các số luồng torch và batch size khác nhau.
+
+        Chọn số luồng cho đường query đơn (độ trễ 1 câu thấp nhất) và cho đường batch
+        (số câu/giây cao nhất), cùng batch size tốt nhất của từng encoder. Kết quả được lưu
+        vào path và dùng lại khi phần cứng không đổi. Trả về cấu hình đã chọn.
+        """
+        signature = self._hardware_signature()
+        if path and not force and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('signature') == signature:
+                self.tuning = saved
+                self._apply_batch_sizes()
+                return saved
+
+        if not self.encoders:
+            raise RuntimeError("Chưa có encoder để autotune")
+
+        # Câu mẫu lấy ngẫu nhiên từ corpus (cố định seed để các lần đo so sánh được)
+        sentences = self.df['Câu tiếng Hán'].dropna().astype(str)
+        sample = preprocess_texts(sentences.sample(min(sample_size, len(sentences)), random_state=0).tolist())
+        single_text = [sorted(sample, key=len)[len(sample) // 2]]
+        original_threads = torch.get_num_threads()
+        thread_candidates = _thread_candidates(available_cpus()) if str(self.device) == 'cpu' else [original_threads]
+        probe_batch = min(32, len(sample))
+
+        print(f"Autotuning encoders on {len(sample)} sentences, threads {thread_candidates}...")
+        single_latency = {}
+        batch_throughput = {}
+        try:
+            for threads in thread_candidates:
+                torch.set_num_threads(threads)
+                single_latency[threads] = 0.0
+                batch_throughput[threads] = 0.0
+                for encoder in self.encoders.values():
+                    encoder.encode(single_text)  # lần chạy đầu có chi phí khởi tạo
+                    single_latency[threads] += _time_encode(encoder, single_text, repeat=3)
+                    batch_throughput[threads] += probe_batch / _time_encode(encoder, sample[:probe_batch])
+
+            single_threads = min(single_latency, key=single_latency.get)
+            batch_threads = max(batch_throughput, key=batch_throughput.get)
+
+            torch.set_num_threads(batch_threads)
+            best_batch_sizes = {}
+            sentences_per_sec = {}
+            for name, encoder in self.encoders.items():
+                default_batch_size = encoder.batch_size
+                timings = {}
+                for batch_size in batch_sizes:
+                    if batch_size > len(sample) and timings:
+                        break
+                    encoder.batch_size = batch_size
+                    timings[batch_size] = _time_encode(encoder, sample)
+                encoder.batch_size = default_batch_size
+                best_batch_sizes[name] = min(timings, key=timings.get)
+                sentences_per_sec[name] = round(len(sample) / timings[best_batch_sizes[name]], 1)
+        finally:
+            torch.set_num_threads(original_threads)
+
+        self.tuning = {
+            'signature': signature,
+            'single': {'threads': single_threads, 'latency_ms': round(single_latency[single_threads] * 1000, 1)},
+            'batch': {'threads': batch_threads, 'batch_size': best_batch_sizes,
+                      'sentences_per_sec': sentences_per_sec},
+            'tuned_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self._apply_batch_sizes()
+        print(f"Autotune: single-query {single_threads} threads, batch {batch_threads} threads, "
+              f"batch size {best_batch_sizes}")
+
+        if path:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.tuning, f, indent=2)
+            os.replace(tmp_path, path)
+        return self.tuning
+
+    def collapse_duplicates(self, similarity=0.97):
+        """Gộp các dòng trùng lặp của corpus, mỗi nhóm chỉ giữ một vector.
+
+        Hai dòng cùng nhóm khi cùng quyển, cùng translation và best_match, và hoặc có câu Hán
+        giống nhau sau normalize_han_key, hoặc có embeddings tiếng Hán (mọi mô hình) với cosine
+        >= similarity. Dòng đại diện là dòng đầu tiên của nhóm; cột 'refs' giữ danh sách
+        (trang, quyển) của mọi dòng trong nhóm. Trả về báo cáo số dòng/bộ nhớ trước và sau.
+        """
+        if 'refs' in self.df.columns:
+            raise RuntimeError("Corpus đã được gộp trùng lặp")
+        han_embeddings = [e for e in (self.han_embeddings_phobert, self.han_embeddings_labse) if e is not None]
+        if self.shard_store is not None or not han_embeddings:
+            raise RuntimeError("Cần vectorstore có embeddings đầy đủ trong bộ nhớ (không phải dạng shard)")
+
+        df = self.df.reset_index(drop=True)
+        volumes = df['volumn'].fillna(UNKNOWN_VOLUME).astype(str).tolist()
+        translations = df['translation'].fillna('').astype(str).tolist()
+        best_matches = df['best_match'].fillna('').astype(str).tolist()
+        han_keys = [normalize_han_key(h) for h in df['Câu tiếng Hán'].astype(str).tolist()]
+
+        # Bước 1: trùng câu Hán sau chuẩn hóa
+        parent = np.arange(len(df))
+        first = {}
+        for i, key in enumerate(zip(volumes, translations, best_matches, han_keys)):
+            parent[i] = first.setdefault(key, i)
+        exact_duplicates = int((parent != np.arange(len(df))).sum())
+
+        # Bước 2: gần trùng theo embeddings, chỉ so trong cùng (quyển, translation, best_match)
+        buckets = {}
+        for i in np.flatnonzero(parent == np.arange(len(df))):
+            buckets.setdefault((volumes[i], translations[i], best_matches[i]), []).append(i)
+        near_duplicates = 0
+        for rows in buckets.values():
+            if len(rows) < 2:
+                continue
+            index = torch.as_tensor(rows)
+            sims = None
+            for embeddings in han_embeddings:
+                vectors = F.normalize(embeddings[index.to(embeddings.device)].float().cpu(), dim=1)
+                model_sims = vectors @ vectors.T
+                sims = model_sims if sims is None else torch.minimum(sims, model_sims)
+            merged = set()
+            for a in range(len(rows)):
+                if a in merged:
+                    continue
+                for b in range(a + 1, len(rows)):
+                    if b not in merged and sims[a, b] >= similarity:
+                        parent[rows[b]] = rows[a]
+                        merged.add(b)
+            near_duplicates += len(merged)
+        parent = parent[parent]
+
+        representatives = np.flatnonzero(parent == np.arange(len(df)))
+        members = {}
+        for i, root in enumerate(parent):
+            members.setdefault(root, []).append(i)
+        pages = pd.to_numeric(df['Page'], errors='coerce').tolist()
+
+        def ref(i):
+            return (None if pages[i] != pages[i] else int(pages[i]), volumes[i])
+
+        collapsed = df.iloc[representatives].copy()
+        collapsed['refs'] = [tuple(sorted({ref(i) for i in members[root]}, key=lambda r: (r[0] is None, r[0] or 0)))
+                             for root in representatives]
+
+        embedding_bytes_before = 0
+        embedding_bytes_after = 0
+        for key in EMBEDDING_KEYS.values():
+            embeddings = getattr(self, key)
+            if embeddings is None:
+                continue
+            reduced = embeddings[torch.as_tensor(representatives, device=embeddings.device)].clone()
+            embedding_bytes_before += object_size(embeddings)
+            embedding_bytes_after += object_size(reduced)
+            setattr(self, key, reduced)
+
+        pairs_before = set(zip(translations, best_matches))
+        pairs_after = set(zip(collapsed['translation'].fillna('').astype(str), collapsed['best_match'].fillna('').astype(str)))
+        self.df = collapsed.reset_index(drop=True)
+        # Encoder đăng ký riêng vẫn được dùng nên giữ revision để khóa cache tách khỏi process khác
+        backend_revision = self._backend_revision
+        self._reset_indexes()
+        self._backend_revision = backend_revision
+        self._rebuild_indexes()
+
+        return {
+            'rows_before': len(df),
+            'rows_after': len(self.df),
+            'exact_duplicates': exact_duplicates,
+            'near_duplicates': near_duplicates,
+            'shrink_pct': round(100 * (1 - len(self.df) / len(df)), 2) if len(df) else 0.0,
+            'embedding_mb_before': round(embedding_bytes_before / _MB, 2),
+            'embedding_mb_after': round(embedding_bytes_after / _MB, 2),
+            'distinct_translations_before': len(pairs_before),
+            'distinct_translations_after': len(pairs_after),
+            'translations_lost': len(pairs_before - pairs_after),
+        }
+
+    def apply_tuning(self, mode='single'):
+        """Đặt số luồng torch theo cấu hình autotune cho đường 'single' (API) hoặc 'batch' (dịch hàng loạt)"""
+        if not self.tuning:
+            return None
+        threads = self.tuning[mode]['threads']
+        torch.set_num_threads(threads)
+        return threads
+
+    def has_reverse_index(self):
+        """Có index tiếng Việt để tra ngược Việt -> Hán hay không"""
+        return 'phobert' in self.encoders and any(name in self.indexes for name in VIETNAMESE_INDEXES)
+
+    def _encode_queries(self, model_name, texts):
+        """Encode một batch query bằng một mô hình; None nếu mô hình không dùng được"""
+        if not self._has_embeddings(model_name):
+            return None
+
+        try:
+            if self.cache is None:
+                return self.encoders[model_name].encode(texts)
+
+            # Cache embeddings theo từng câu: cùng câu với bộ lọc/top_k khác không phải encode lại
+            keys = [('embedding', self.version, model_name, t) for t in texts]
+            embeddings = [self.cache.get(key) for key in keys]
+            misses = [i for i, e in enumerate(embeddings) if e is None]
+            if misses:
+                fresh = self.encoders[model_name].encode([texts[i] for i in misses])
+                for i, e in zip(misses, fresh):
+                    embeddings[i] = e.cpu().clone()
+                    self.cache.put(keys[i], embeddings[i])
+            return torch.stack(embeddings)
+        except Exception as e:
+            print(f"{'PhoBERT' if model_name == 'phobert' else 'LaBSE'} search failed: {str(e)}")
+            return None
+
+    def _filter_mask(self, volumes=None, page_range=None):
+        """Mặt nạ các dòng thuộc quyển/khoảng trang được chọn; None nếu không lọc"""
+        if volumes is None and page_range is None:
+            return None
+        self._ensure_indexes()
+        mask = np.ones(len(self.df), dtype=bool)
+        if volumes is not None:
+            mask &= np.isin(self._row_volumes, list(volumes))
+        if page_range is not None:
+            start, end = page_range
+            pages = self._row_pages if self._ref_rows is None else self._ref_pages
+            in_range = np.ones(len(pages), dtype=bool)
+            if start is not None:
+                in_range &= pages >= start
+            if end is not None:
+                in_range &= pages <= end
+            if self._ref_rows is not None:
+                # Dòng đã gộp khớp nếu có ít nhất một ref nằm trong khoảng trang
+                in_range = np.bincount(self._ref_rows[in_range], minlength=len(self.df)) > 0
+            mask &= in_range
+        return mask
+
+    def loaded_volumes(self):
+        """Các quyển đang có embeddings trong bộ nhớ"""
+        if self.shards is None:
+            return []
+        if self.shard_store is None:
+            return list(self.shards)
+        return self.shard_store.loaded()
+
+    def _semantic_hits(self, model_name, query_embedding, top_k, mask=None, volumes=None):
+        """Tìm top_k cho một query embedding, chỉ quét các dòng trong mask (None: toàn bộ)"""
+        hits = self.indexes[model_name].search(query_embedding, top_k, mask=mask, volumes=volumes)
+        for hit in hits:
+            hit['model'] = model_name
+        return hits
+
+    @staticmethod
+    def _merge_hits(hits, top_k):
+        """Gộp hit của nhiều encoder/index theo corpus_id, giữ điểm cao nhất, trả về top_k"""
+        best = {}
+        for hit in hits:
             idx = hit['corpus_id']
+            if idx not in best or hit['score'] > best[idx]['score']:
+                best[idx] = hit
+        return sorted(best.values(), key=lambda x: -x['score'])[:top_k]
+
+    def _hits_to_results(self, hits, stage):
+        results = []
+        for hit in hits:
+            row = self.df.iloc[hit['corpus_id']]
             results.append({
-                'han_original': self.df.iloc[idx]['Câu tiếng Hán'],
-                'translation': self.df.iloc[idx]['translation'],
-                'best_match': self.df.iloc[idx]['best_match'],
+                'han_original': row['Câu tiếng Hán'],
+                'translation': row['translation'],
+                'best_match': row['best_match'],
                 'score': hit['score'],
-                'model': hit['model']
+                'model': hit['model'],
+                'stage': hit.get('stage', stage),
+                'page': row.get('Page'),
+                'volume': row.get('volumn') if isinstance(row.get('volumn'), str) else UNKNOWN_VOLUME
             })
-            
+            if 'matched_field' in hit:
+                results[-1]['matched_field'] = hit['matched_field']
+            if 'refs' in row:
+                results[-1]['refs'] = [{'page': page, 'volume': volume} for page, volume in row['refs']]
+        return results
+
+    def _char_candidates(self, query_key, filter_mask=None):
+        """Lọc ứng viên theo tỷ lệ ký tự chung với query; None nghĩa là quét toàn bộ"""
+        query_chars = han_chars(query_key)
+        if not query_chars:
+            return None
+
+        overlap = np.zeros(len(self.df), dtype=np.int32)
+        for c in query_chars:
+            rows = self._char_postings.get(c)
+            if rows is not None:
+                overlap[rows] += 1
+        if filter_mask is not None:
+            overlap[~filter_mask] = 0
+
+        min_shared = max(1, int(np.ceil(self.min_char_overlap * len(query_chars))))
+        candidates = np.flatnonzero(overlap >= min_shared)
+        if len(candidates) == 0:
+            return None
+        if len(candidates) > self.max_candidates:
+            order = np.argsort(-overlap[candidates], kind='stable')[:self.max_candidates]
+            candidates = np.sort(candidates[order])
+        return candidates
+
+    def cascade_search_batch(self, queries, top_k=1, volumes=None, page_range=None):
+        """Tìm kiếm theo cascade cho một batch query, dừng ở tầng rẻ nhất đủ tin cậy.
+
+        1. exact: khớp nguyên văn câu tiếng Hán đã chuẩn hóa; nếu ít hơn top_k dòng khớp,
+           các chỗ còn lại lấy từ encoder chính
+        2. lọc ứng viên theo ký tự chung, rồi chạy encoder chính (mặc định LaBSE)
+        3. encoder phụ (PhoBERT) chỉ chạy khi điểm cao nhất nằm trong
+           khoảng threshold ± ambiguity_margin
+        Mỗi encoder chỉ được gọi một lần cho cả batch. Hit của các tầng được gộp theo
+        dòng corpus (giữ điểm cao nhất). Mỗi kết quả có trường 'stage' cho biết tầng đã trả lời.
+        """
+        self._ensure_indexes()
+        filter_mask = self._filter_mask(volumes, page_range)
+
+        results = [None] * len(queries)
+        pending = []
+        exact_hits = {}
+        keys = [normalize_han_key(q) for q in queries]
+        for i, key in enumerate(keys):
+            exact_rows = self._exact_index.get(key, [])
+            if filter_mask is not None:
+                exact_rows = [idx for idx in exact_rows if filter_mask[idx]]
+            hits = [{'corpus_id': idx, 'score': 1.0, 'model': 'exact', 'stage': 'exact'}
+                    for idx in exact_rows[:top_k]]
+            if len(hits) >= top_k:
+                results[i] = self._hits_to_results(hits, 'exact')
+            else:
+                exact_hits[i] = hits
+                pending.append(i)
+        if not pending:
+            return results
+
+        # Mặt nạ quét cho từng query: ứng viên theo ký tự giao với bộ lọc quyển/trang;
+        # ít ứng viên hơn top_k thì quét cả phần được lọc để đủ số kết quả
+        candidates = {}
+        for i in pending:
+            rows = self._char_candidates(keys[i], filter_mask)
+            if rows is None or len(rows) < top_k:
+                candidates[i] = filter_mask
+            else:
+                candidates[i] = np.zeros(len(self.df), dtype=bool)
+                candidates[i][rows] = True
+        processed = dict(zip(pending, preprocess_texts([queries[i] for i in pending])))
+
+        primary = self.primary_model
+        secondary = 'phobert' if primary == 'labse' else 'labse'
+        all_hits = {i: list(exact_hits[i]) for i in pending}
+        stages = {i: primary for i in pending}
+
+        embeddings = self._encode_queries(primary, [processed[i] for i in pending])
+        if embeddings is None:
+            need_secondary = [i for i in pending if not exact_hits[i]]
+        else:
+            need_secondary = []
+            for row, i in enumerate(pending):
+                hits = self._semantic_hits(primary, embeddings[row], top_k, candidates[i], volumes)
+                all_hits[i].extend(hits)
+                # Đã có dòng khớp nguyên văn thì câu trả lời đầu là chắc chắn, không cần encoder phụ
+                if not exact_hits[i] and (not hits or abs(hits[0]['score'] - self.threshold) <= self.ambiguity_margin):
+                    need_secondary.append(i)
+
+        if need_secondary:
+            embeddings = self._encode_queries(secondary, [processed[i] for i in need_secondary])
+            if embeddings is not None:
+                for row, i in enumerate(need_secondary):
+                    stages[i] = secondary
+                    all_hits[i].extend(self._semantic_hits(secondary, embeddings[row], top_k, candidates[i], volumes))
+
+        for i in pending:
+            if not all_hits[i]:
+                self._log("⚠️  No semantic search results, using simple text search...")
+                results[i] = self.simple_search(queries[i], top_k, volumes, page_range)
+            else:
+                results[i] = self._hits_to_results(self._merge_hits(all_hits[i], top_k), stages[i])
+        return results
+
+    def cascade_search(self, query_han, top_k=1, volumes=None, page_range=None):
+        """Cascade cho một query (xem cascade_search_batch)"""
+        return self.cascade_search_batch([query_han], top_k, volumes, page_range)[0]
+
+    def search_batch(self, queries, top_k=1, cascade=None, volumes=None, page_range=None, direction='han2vi'):
+        """Tìm kiếm cho nhiều câu cùng lúc, encode cả batch trong một lần gọi mô hình.
+
+        volumes: danh sách quyển (giá trị cột 'volumn') cần tìm, page_range: (trang đầu, trang cuối).
+        Bộ lọc giới hạn phần corpus được quét chứ không lọc kết quả sau khi tìm.
+        direction: 'han2vi' (mặc định, query tiếng Hán) hoặc 'vi2han' (query tiếng Việt,
+        tìm câu Hán gốc qua index tiếng Việt).
+        """
+        if not self.is_loaded:
+            raise RuntimeError("Vectorstore chưa được load")
+        if direction not in SEARCH_DIRECTIONS:
+            raise ValueError(f"direction phải là một trong {SEARCH_DIRECTIONS}")
+
+        cascade = self.use_cascade if cascade is None else cascade
+        if self.profiler is not None:
+            with self.profiler.track_query(len(queries)):
+                return self._cached_search_batch(queries, top_k, cascade, volumes, page_range, direction)
+        return self._cached_search_batch(queries, top_k, cascade, volumes, page_range, direction)
+
+    def _cached_search_batch(self, queries, top_k, cascade, volumes, page_range, direction):
+        if self.cache is None:
+            return self._search_batch(queries, top_k, cascade, volumes, page_range, direction)
+
+        # Cache theo câu đã tiền xử lý + tham số tìm kiếm; chỉ tìm các câu chưa có trong cache
+        filters = (tuple(volumes) if volumes is not None else None,
+                   tuple(page_range) if page_range is not None else None)
+        config = (self.threshold, self.ambiguity_margin, self.min_char_overlap, self.max_candidates, self.primary_model)
+        keys = [(self.version, q, top_k, cascade, filters, direction, config) for q in preprocess_texts(queries)]
+        results = [self.cache.get(key) for key in keys]
+        misses = [i for i, r in enumerate(results) if r is None]
+        if misses:
+            fresh = self._search_batch([queries[i] for i in misses], top_k, cascade, volumes, page_range, direction)
+            for i, r in zip(misses, fresh):
+                self.cache.put(keys[i], r)
+                results[i] = r
+        return [[dict(hit) for hit in r] for r in results]
+
+    def _search_batch(self, queries, top_k, cascade, volumes, page_range, direction='han2vi'):
+        if direction == 'vi2han':
+            return self.reverse_search_batch(queries, top_k, volumes, page_range)
+
+        # Kiểm tra xem có embeddings không
+        if not self._has_embeddings('phobert') and not self._has_embeddings('labse'):
+            self._log("⚠️  No embeddings available, using simple text search...")
+            return [self.simple_search(q, top_k, volumes, page_range) for q in queries]
+
+        if cascade:
+            return self.cascade_search_batch(queries, top_k, volumes, page_range)
+
+        self._ensure_indexes()
+        filter_mask = self._filter_mask(volumes, page_range)
+
+        # Tiền xử lý query
+        processed = preprocess_texts(queries)
+
+        # Encode query bằng cả hai mô hình và tìm kiếm trên toàn bộ corpus
+        all_hits = [[] for _ in queries]
+        for model_name in ('phobert', 'labse'):
+            embeddings = self._encode_queries(model_name, processed)
+            if embeddings is None:
+                continue
+            for row in range(len(queries)):
+                all_hits[row].extend(self._semantic_hits(model_name, embeddings[row], top_k, filter_mask, volumes))
+
+        results = []
+        for query_han, hits in zip(queries, all_hits):
+            # Nếu không có kết quả từ embeddings, dùng simple search
+            if not hits:
+                self._log("⚠️  No semantic search results, using simple text search...")
+                results.append(self.simple_search(query_han, top_k, volumes, page_range))
+                continue
+            # Gộp hit của hai mô hình theo dòng corpus, sort by score
+            results.append(self._hits_to_results(self._merge_hits(hits, top_k), 'full'))
+        return results
+
+    def reverse_search_batch(self, queries, top_k=1, volumes=None, page_range=None):
+        """Tra ngược Việt -> Hán: encode query tiếng Việt một lần bằng PhoBERT rồi tìm
+        trên index của cột translation và best_match; mỗi dòng corpus giữ điểm cao nhất
+        và ghi lại cột khớp ở 'matched_field'.
+        """
+        if not self.has_reverse_index():
+            raise RuntimeError("Vectorstore chưa có index tiếng Việt, hãy tạo bằng create_vietnamese_embeddings()")
+
+        self._ensure_indexes()
+        filter_mask = self._filter_mask(volumes, page_range)
+        embeddings = self._encode_queries('phobert', preprocess_texts(queries))
+        if embeddings is None:
+            return [[] for _ in queries]
+
+        results = []
+        for row in range(len(queries)):
+            hits = []
+            for index_name, column in VIETNAMESE_INDEXES.items():
+                if index_name not in self.indexes:
+                    continue
+                for hit in self.indexes[index_name].search(embeddings[row], top_k, mask=filter_mask, volumes=volumes):
+                    hits.append({'corpus_id': hit['corpus_id'], 'score': hit['score'], 'model': 'phobert',
+                                 'matched_field': column})
+            results.append(self._hits_to_results(self._merge_hits(hits, top_k), 'vi2han'))
         return results
+
+    def warm_up(self, queries, batch_size=32):
+        """Chạy trước các câu hay được hỏi [(query, direction)] để nạp cache (bộ lọc mặc định)"""
+        if self.cache is None or not queries:
+            return 0
+        verbose, self.verbose = self.verbose, False
+        try:
+            for direction in SEARCH_DIRECTIONS:
+                texts = [q for q, d in queries if d == direction]
+                if direction == 'vi2han' and not self.has_reverse_index():
+                    continue
+                for i in range(0, len(texts), batch_size):
+                    self.search_batch(texts[i:i + batch_size], direction=direction)
+        finally:
+            self.verbose = verbose
+        return len(queries)
+
+    def search(self, query_han, top_k=1, cascade=None, volumes=None, page_range=None, direction='han2vi'):
+        """Tìm kiếm câu tiếng Việt tương ứng (hoặc câu Hán gốc khi direction='vi2han')"""
+        self._log(f"Searching for: {query_han}")
+        return self.search_batch([query_han], top_k=top_k, cascade=cascade,
+                                 volumes=volumes, page_range=page_range, direction=direction)[0]
+
+    def search_passage(self, passage, top_k=1, chunk_size=8, volumes=None, page_range=None):
+        """Tách đoạn văn thành câu và tìm kiếm, trả về kết quả từng câu ngay khi xong.
+
+        Batch đầu chỉ có một câu để câu đầu tiên có kết quả sớm, các batch sau
+        tăng gấp đôi (2, 4, ...) cho tới chunk_size câu.
+        """
+        # Cả đoạn trùng nguyên văn một câu trong corpus thì không tách
+        self._ensure_indexes()
+        if normalize_han_key(passage) in self._exact_index:
+            segments = [passage.strip()]
+        else:
+            segments = split_passage(passage)
+        self._log(f"Searching passage with {len(segments)} segments")
+        start, size = 0, 1
+        while start < len(segments):
+            chunk = segments[start:start + size]
+            batch_results = self.search_batch(chunk, top_k=top_k, volumes=volumes, page_range=page_range)
+            for offset, results in enumerate(batch_results):
+                yield {
+                    'index': start + offset,
+                    'total': len(segments),
+                    'segment': chunk[offset],
+                    'results': results
+                }
+            start += len(chunk)
+            size = min(size * 2, chunk_size)
     
-    def simple_search(self, query_han, top_k=1):
+    def simple_search(self, query_han, top_k=1, volumes=None, page_range=None):
         """Tìm kiếm đơn giản bằng text matching"""
-        print(f"Simple search for: {query_han}")
+        self._log(f"Simple search for: {query_han}")
         
         results = []
         query_lower = query_han.lower()
+        filter_mask = self._filter_mask(volumes, page_range)
         
         # Tìm kiếm trong DataFrame
-        for idx, row in self.df.iterrows():
+        for pos, (idx, row) in enumerate(self.df.iterrows()):
+            if filter_mask is not None and not filter_mask[pos]:
+                continue
             han_text = str(row['Câu tiếng Hán']).lower()
             
             # Tính điểm đơn giản dựa trên độ tương đồng
@@ -313,7 +1583,10 @@ class HanVietVectorStore:
                 'translation': row['translation'],
                 'best_match': row['best_match'],
                 'score': score,
-                'model': 'simple'
+                'model': 'simple',
+                'stage': 'simple',
+                'page': row.get('Page'),
+                'volume': row.get('volumn') if isinstance(row.get('volumn'), str) else UNKNOWN_VOLUME
             })
         
         # Sort và trả về top_k kết quả
@@ -321,15 +1594,52 @@ class HanVietVectorStore:
         return results
 
 # ========== Main Functions ==========
-def create_vectorstore(data_path):
-    """Tạo vectorstore từ data"""
+def create_vectorstore(data_path, dedup_similarity=None):
+    """Tạo vectorstore từ data; dedup_similarity: gộp các dòng trùng lặp trước khi lưu"""
     vectorstore = HanVietVectorStore(data_path)
     vectorstore.load_data()
     vectorstore.initialize_models()
     vectorstore.create_embeddings()
+    if dedup_similarity is not None:
+        print(vectorstore.collapse_duplicates(similarity=dedup_similarity))
     vectorstore.save_vectorstore()
     return vectorstore
 
+def add_vietnamese_index(vectorstore_path):
+    """Bổ sung index tiếng Việt vào file .pkl có sẵn (chỉ encode các cột tiếng Việt)"""
+    vectorstore = HanVietVectorStore(None)
+    vectorstore.load_vectorstore(vectorstore_path)
+    vectorstore.create_vietnamese_embeddings()
+    vectorstore.save_vectorstore(vectorstore_path)
+    return vectorstore
+
+def reduce_vectorstore(vectorstore_path, output_path, dim=256, method='pca'):
+    """Tạo bản vectorstore giảm chiều từ file .pkl đủ chiều"""
+    vectorstore = HanVietVectorStore(None)
+    vectorstore.load_vectorstore(vectorstore_path)
+    vectorstore.reduce_dimensions(dim=dim, method=method)
+    vectorstore.save_vectorstore(output_path)
+    return vectorstore
+
+def dedup_vectorstore(vectorstore_path, output_path, similarity=0.97):
+    """Tạo bản vectorstore đã gộp các dòng trùng lặp và in báo cáo"""
+    vectorstore = HanVietVectorStore(None)
+    vectorstore.load_vectorstore(vectorstore_path)
+    report = vectorstore.collapse_duplicates(similarity=similarity)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if report['translations_lost']:
+        raise RuntimeError("Gộp trùng lặp làm mất bản dịch, không lưu kết quả")
+    vectorstore.save_vectorstore(output_path)
+    return vectorstore
+
+def export_shards(vectorstore_path, shard_dir):
+    """Chuyển file .pkl (một khối) thành thư mục shard theo quyển"""
+    vectorstore = HanVietVectorStore(None)
+    vectorstore.load_vectorstore(vectorstore_path)
+    vectorstore.save_shards(shard_dir)
+    return vectorstore
+
 def load_and_search(query_han, vectorstore_path="han_viet_vectorstore.pkl"):
     """Load vectorstore và tìm kiếm - chỉ dùng file .pkl, lỗi là dừng"""
     if not os.path.exists(vectorstore_path):
@@ -368,4 +1678,30 @@ def demo():
         print(f"   Best Match: {result['best_match']}")
 
 if __name__ == '__main__':
-    demo() 
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Hệ thống tìm kiếm Hán-Việt")
+    parser.add_argument('--export-shards', metavar='DIR',
+                        help="Chuyển han_viet_vectorstore.pkl thành thư mục shard theo quyển")
+    parser.add_argument('--add-vi-index', action='store_true',
+                        help="Bổ sung index tiếng Việt (tra ngược Việt -> Hán) vào file .pkl")
+    parser.add_argument('--reduce-dim', type=int, default=None, metavar='DIM',
+                        help="Giảm số chiều embeddings (vd 128, 256), ghi ra --output")
+    parser.add_argument('--reduce-method', choices=Projection.METHODS, default='pca')
+    parser.add_argument('--dedup', action='store_true',
+                        help="Gộp các dòng trùng lặp (cùng bản dịch), mỗi nhóm một vector, ghi ra --output")
+    parser.add_argument('--similarity', type=float, default=0.97, help="Ngưỡng cosine coi là gần trùng cho --dedup")
+    parser.add_argument('--output', default=None, help="File .pkl kết quả cho --reduce-dim / --dedup")
+    parser.add_argument('--vectorstore', default="han_viet_vectorstore.pkl")
+    args = parser.parse_args()
+    if args.dedup:
+        dedup_vectorstore(args.vectorstore, args.output or args.vectorstore.replace('.pkl', '_dedup.pkl'),
+                          similarity=args.similarity)
+    elif args.reduce_dim:
+        output = args.output or args.vectorstore.replace('.pkl', f'_{args.reduce_method}{args.reduce_dim}.pkl')
+        reduce_vectorstore(args.vectorstore, output, dim=args.reduce_dim, method=args.reduce_method)
+    elif args.add_vi_index:
+        add_vietnamese_index(args.vectorstore)
+    elif args.export_shards:
+        export_shards(args.vectorstore, args.export_shards)
+    else:
+        demo() 
\ No newline at end of file
@@ -2,227 +2,46 @@
 # -*- coding: utf-8 -*-
 """
 Ứng dụng dịch tiếng Hán sang tiếng Việt sử dụng model online từ Hugging Face
+Cần han_viet_search_system.py và download_model.py nằm cùng thư mục
 Cài đặt các thư viện cần thiết với câu lệnh bên dưới
 Khuyến nghị chạy bằng google colab vì có GPU
 !pip install torch torchvision torchaudio transformers sentence-transformers pandas numpy requests
 """
 
 import torch
-import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
-from transformers import AutoTokenizer, AutoModel
-import unicodedata
-import re
-import pickle
-import requests
-import gc
-
-def preprocess_texts(texts, lower=True, remove_stopwords=False, stopwords=None, norm_unicode='NFC'):
-    def clean_text(s):
-        if not isinstance(s, str):
-            return ""
-        s = unicodedata.normalize(norm_unicode, s)
-        s = re.sub(r'\s+', ' ', s.strip())
-        if lower:
-            s = s.lower()
-        s = re.sub(r'([.,!?;:]){2,}', r'\1', s)
-        s = re.sub(r'\s+([.,!?;:])', r'\1', s)
-        if remove_stopwords and stopwords:
-            words = s.split()
-            words = [w for w in words if w not in stopwords]
-            s = ' '.join(words)
-        return s
-    return [clean_text(t) for t in texts]
-
-def load_phobert_model(device=None):
-    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
-    tokenizer = AutoTokenizer.from_pretrained('vinai/phobert-base')
-    model = AutoModel.from_pretrained('vinai/phobert-base')
-    model.to(device)
-    model.eval()
-    return tokenizer, model, device
-
-def phobert_encode(texts, tokenizer, model, device, batch_size=64):
-    all_embeddings = []
-    with torch.no_grad():
-        for i in range(0, len(texts), batch_size):
-            batch_texts = texts[i:i+batch_size]
-            encoded = tokenizer(batch_texts, padding=True, truncation=True, max_length=256, return_tensors='pt')
-            input_ids = encoded['input_ids'].to(device)
-            attention_mask = encoded['attention_mask'].to(device)
-            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-            last_hidden = outputs.last_hidden_state
-            mask = attention_mask.unsqueeze(-1).expand(last_hidden.size()).float()
-            summed = torch.sum(last_hidden * mask, 1)
-            counts = torch.clamp(mask.sum(1), min=1e-9)
-            mean_pooled = summed / counts
-            all_embeddings.append(mean_pooled.cpu())
-    return torch.cat(all_embeddings, dim=0)
-
-def load_labse_model(device=None):
-    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
-    model = SentenceTransformer('sentence-transformers/LaBSE', device=device)
-    model.eval()
-    if device == 'cuda':
-        model.half()
-    return model, device
-
-def labse_encode(texts, model, batch_size=128):
-    with torch.no_grad():
-        embeddings = model.encode(texts, convert_to_tensor=True, batch_size=batch_size, device=model.device)
-    return embeddings
-
-def load_pickle_from_url():
-    hf_url = "https://huggingface.co/datasets/ntvinh12052001/han_viet_vectorstore/resolve/main/han_viet_vectorstore.pkl"
-    try:
-        session = requests.Session()
-        session.timeout = 300
-        response = session.get(hf_url, stream=True, timeout=300)
-        response.raise_for_status()
-
-        content_type = response.headers.get('content-type', '')
-        if 'text/html' in content_type:
-            return None
-
-        pickle_data = response.content
-        data = pickle.loads(pickle_data)
-        return data
-
-    except Exception as e:
-        return None
-
-class HanVietVectorStore:
-    def __init__(self):
-        self.df = None
-        self.han_embeddings_phobert = None
-        self.han_embeddings_labse = None
-        self.phobert_tokenizer = None
-        self.phobert_model = None
-        self.labse_model = None
-        self.device = None
-        self.is_loaded = False
-
-    def load_vectorstore_from_url(self):
-        vectorstore_data = load_pickle_from_url()
-        if vectorstore_data is None:
-            raise RuntimeError("Không thể load vectore store (file .pkl) từ Hugging Face cá nhân!")
-
-        self.df = vectorstore_data['df']
-        gc.collect()
-
-        self.han_embeddings_phobert = vectorstore_data.get('han_embeddings_phobert')
-        gc.collect()
-
-        self.han_embeddings_labse = vectorstore_data.get('han_embeddings_labse')
-        gc.collect()
-
-        self.phobert_tokenizer = vectorstore_data.get('phobert_tokenizer')
-        self.phobert_model = vectorstore_data.get('phobert_model')
-        self.labse_model = vectorstore_data.get('labse_model')
-        self.device = vectorstore_data.get('device', 'cpu')
-
-        if self.phobert_model is not None:
-            self.phobert_model = self.phobert_model.cpu()
-        if self.labse_model is not None:
-            self.labse_model = self.labse_model.cpu()
-
-        gc.collect()
-        self.is_loaded = True
-
-    def search(self, query_han, top_k=3):
-        if not self.is_loaded:
-            raise RuntimeError("Vectorstore chưa được load")
-
-        if self.han_embeddings_phobert is None and self.han_embeddings_labse is None:
-            return self.simple_search(query_han, top_k)
-
-        query_processed = preprocess_texts([query_han])[0]
-        all_hits = []
-
-        if self.han_embeddings_phobert is not None and self.phobert_tokenizer is not None:
-            try:
-                query_embedding_phobert = phobert_encode(
-                    [query_processed], self.phobert_tokenizer, self.phobert_model, self.device
-                )
-                hits_phobert = util.semantic_search(
-                    query_embedding_phobert, self.han_embeddings_phobert, top_k=top_k
-                )[0]
-                for hit in hits_phobert:
-                    hit['model'] = 'phobert'
-                    all_hits.append(hit)
-            except Exception as e:
-                pass
-
-        if self.han_embeddings_labse is not None and self.labse_model is not None:
-            try:
-                query_embedding_labse = labse_encode([query_processed], self.labse_model)
-                hits_labse = util.semantic_search(
-                    query_embedding_labse, self.han_embeddings_labse, top_k=top_k
-                )[0]
-                for hit in hits_labse:
-                    hit['model'] = 'labse'
-                    all_hits.append(hit)
-            except Exception as e:
-                pass
-
-        if not all_hits:
-            return self.simple_search(query_han, top_k)
-
-        all_hits = sorted(all_hits, key=lambda x: -x['score'])[:top_k]
-
-        results = []
-        for hit in all_hits:
-            idx = hit['corpus_id']
-            results.append({
-                'han_original': self.df.iloc[idx]['Câu tiếng Hán'],
-                'translation': self.df.iloc[idx]['translation'],
-                'best_match': self.df.iloc[idx]['best_match'],
-                'score': hit['score'],
-                'model': hit['model']
-            })
-
-        return results
-
-    def simple_search(self, query_han, top_k=3):
-        results = []
-        query_lower = query_han.lower()
-
-        for idx, row in self.df.iterrows():
-            han_text = str(row['Câu tiếng Hán']).lower()
-
-            if query_lower in han_text or han_text in query_lower:
-                score = 0.8
-            elif any(char in han_text for char in query_lower):
-                score = 0.3
-            else:
-                continue
-
-            results.append({
-                'han_original': row['Câu tiếng Hán'],
-                'translation': row['translation'],
-                'best_match': row['best_match'],
-                'score': score,
-                'model': 'simple'
-            })
-
-        results = sorted(results, key=lambda x: -x['score'])[:top_k]
-        return results
+import os
+import sys
+import csv
+import json
+import argparse
+import itertools
+
+# Dùng chung engine tìm kiếm với Flask app (han_viet_search_system.py);
+# các hàm encode được import lại để code cũ import từ module này vẫn chạy
+from han_viet_search_system import (
+    HanVietVectorStore, LRUCache, preprocess_texts,
+    load_phobert_model, phobert_encode, load_labse_model, labse_encode, available_cpus
+)
 
 class HanVietTranslator:
-    def __init__(self):
-        self.vectorstore = HanVietVectorStore()
+    def __init__(self, threshold=0.7, ambiguity_margin=0.05, use_cascade=True, model_path=None):
+        self.vectorstore = HanVietVectorStore(
+            threshold=threshold, ambiguity_margin=ambiguity_margin, use_cascade=use_cascade,
+            cache=LRUCache(maxsize=4096), verbose=False
+        )
+        self.model_path = model_path
         self.is_initialized = False
 
     def initialize(self):
         if self.is_initialized:
             return
 
-        try:
+        if self.model_path and os.path.exists(self.model_path):
+            self.vectorstore.load_vectorstore(self.model_path)
+        else:
             self.vectorstore.load_vectorstore_from_url()
-            self.is_initialized = True
-        except Exception as e:
-            raise
+        self.is_initialized = True
 
     def translate(self, han_text, top_k=3):
         if not self.is_initialized:
@@ -243,6 +62,8 @@ class HanVietTranslator:
             return {
                 "success": True,
                 "input": han_text,
+                "stage": results[0]['stage'],
+                "threshold": self.vectorstore.threshold,
                 "results": results
             }
 
@@ -252,9 +73,164 @@ class HanVietTranslator:
                 "input": han_text
             }
 
-def main():
+    def translate_batch(self, han_texts, top_k=1):
+        if not self.is_initialized:
+            self.initialize()
+
+        batch_results = self.vectorstore.search_batch(han_texts, top_k=top_k)
+        return [
+            {
+                "input": han_text,
+                "stage": results[0]['stage'] if results else None,
+                "threshold": self.vectorstore.threshold,
+                "results": results
+            }
+            for han_text, results in zip(han_texts, batch_results)
+        ]
+
+# ========== Dịch hàng loạt ==========
+BATCH_FIELDS = ['line', 'input', 'han_original', 'translation', 'best_match',
+                'score', 'model', 'stage', 'page', 'volume', 'accepted']
+
+def _plain_value(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+        if isinstance(value, float) and np.isnan(value):
+            return None
+    return value
+
+def iter_input_records(input_path, column=None):
+    """Đọc lần lượt từng câu tiếng Hán từ file .txt (mỗi dòng một câu) hoặc .csv"""
+    with open(input_path, encoding='utf-8', newline='') as f:
+        if input_path.lower().endswith('.csv'):
+            reader = csv.DictReader(f)
+            column = column or ('Câu tiếng Hán' if 'Câu tiếng Hán' in reader.fieldnames else reader.fieldnames[0])
+            for row in reader:
+                yield (row.get(column) or '').strip()
+        else:
+            for line in f:
+                yield line.strip()
+
+def _job_fingerprint(input_path, column, output_format):
+    """Nhận diện một lần dịch: file input (đường dẫn, kích thước, mtime), cột và định dạng output"""
+    stat = os.stat(input_path)
+    return {
+        'input': os.path.abspath(input_path),
+        'input_size': stat.st_size,
+        'input_mtime_ns': stat.st_mtime_ns,
+        'column': column,
+        'format': output_format,
+    }
+
+def _load_checkpoint(checkpoint_path, fingerprint):
+    """Checkpoint của đúng lần dịch này; None nếu chưa có. Checkpoint không khớp
+    (input đã bị sửa/thay, khác cột hoặc định dạng) thì từ chối tiếp tục."""
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    changed = [key for key, value in fingerprint.items() if checkpoint.get(key) != value]
+    if changed:
+        raise RuntimeError(f"Checkpoint {checkpoint_path} không khớp với lần dịch này ({', '.join(changed)} đã đổi); "
+                           f"chạy lại với --no-resume để dịch lại từ đầu")
+    return checkpoint
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+def translate_file(translator, input_path, output_path, column=None, batch_size=64,
+                   resume=True, threads=None, top_k=1, tuning_path=None):
+    """Dịch cả file theo batch, ghi kết quả dần ra CSV/JSONL và lưu checkpoint sau mỗi batch.
+
+    Chỉ một batch nằm trong bộ nhớ tại mỗi thời điểm. Checkpoint ghi số câu đã
+    xong và kích thước file output, nên khi chạy lại sẽ cắt bỏ phần ghi dở và
+    tiếp tục từ câu kế tiếp; checkpoint chỉ được dùng khi file input (kích thước,
+    mtime), cột và định dạng output không đổi. Khi resume=True, file output đã có
+    mà không có checkpoint sẽ không bị ghi đè (dùng resume=False / --no-resume).
+    tuning_path: dùng (hoặc tạo) cấu hình autotune cho số luồng và batch size của
+    encoder khi không chỉ định threads.
+    """
+    torch.set_num_threads(threads or available_cpus())
+    output_format = 'jsonl' if output_path.lower().endswith(('.jsonl', '.json')) else 'csv'
+    checkpoint_path = output_path + '.ckpt'
+    fingerprint = _job_fingerprint(input_path, column, output_format)
+
+    checkpoint = _load_checkpoint(checkpoint_path, fingerprint) if resume else None
+    done = 0
+    if checkpoint is not None and os.path.exists(output_path):
+        # Output ngắn hơn phần checkpoint đã ghi nghĩa là checkpoint không thuộc file này;
+        # truncate sẽ chèn byte NUL thay vì cắt bớt
+        if os.path.getsize(output_path) < checkpoint['output_bytes']:
+            raise RuntimeError(f"File {output_path} ngắn hơn trong checkpoint {checkpoint_path}; "
+                               f"chạy lại với --no-resume để dịch lại từ đầu")
+        done = checkpoint['records_done']
+        with open(output_path, 'r+b') as f:
+            f.truncate(checkpoint['output_bytes'])
+        print(f"Tiếp tục từ checkpoint: đã dịch {done} câu")
+    else:
+        if os.path.exists(output_path):
+            if resume:
+                raise RuntimeError(f"File {output_path} đã tồn tại nhưng không có checkpoint; "
+                                   f"chạy lại với --no-resume để ghi đè")
+            os.remove(output_path)
+        # Lần dịch mới: checkpoint cũ (nếu có) không còn ứng với file output
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    translator.initialize()
+    if tuning_path and threads is None:
+        translator.vectorstore.autotune(tuning_path)
+        translator.vectorstore.apply_tuning('batch')
+    records = itertools.islice(iter_input_records(input_path, column), done, None)
+
+    with open(output_path, 'a', encoding='utf-8', newline='') as out:
+        writer = None
+        if output_format == 'csv':
+            writer = csv.DictWriter(out, fieldnames=BATCH_FIELDS)
+            if out.tell() == 0:
+                writer.writeheader()
+
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+
+            non_empty = [text for text in batch if text]
+            translated = iter(translator.translate_batch(non_empty, top_k=top_k)) if non_empty else iter([])
+            for offset, text in enumerate(batch):
+                result = next(translated) if text else {"results": [], "threshold": translator.vectorstore.threshold}
+                best = result['results'][0] if result['results'] else {}
+                record = {field: _plain_value(best.get(field)) for field in BATCH_FIELDS}
+                record['line'] = done + offset + 1
+                record['input'] = text
+                record['score'] = round(float(best['score']), 4) if best else None
+                record['accepted'] = bool(best) and best['score'] >= result['threshold']
+                if writer is not None:
+                    writer.writerow(record)
+                else:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+            out.flush()
+            os.fsync(out.fileno())
+            done += len(batch)
+            _save_checkpoint(checkpoint_path, {
+                **fingerprint,
+                'records_done': done,
+                'output_bytes': out.tell()
+            })
+            print(f"Đã dịch {done} câu")
+
+    return done
+
+def interactive(translator):
     print("Hệ thống dịch Hán-Việt cho y học cổ truyền")
-    translator = HanVietTranslator()
 
     try:
         translator.initialize()
@@ -281,7 +257,7 @@ def main():
             else:
                 print(f"\nKết quả dịch '{result['input']}':\n")
                 for i, res in enumerate(result['results'], 1):
-                    if res['score'] > 0.7:
+                    if res['score'] >= result['threshold']:
                       print(f"Score: {res['score']:.3f}")
                       print(f"{i}. Câu tiếng Hán dich sang tiếng Việt: \n{res['translation']}\n")
                       print(f"Câu tiếng Việt từ trong sách: \n{res['best_match']}")
@@ -294,5 +270,39 @@ def main():
         except Exception as e:
             print(f"Lỗi: {str(e)}")
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dịch câu tiếng Hán sang tiếng Việt cho y học cổ truyền")
+    parser.add_argument('--model-path', default="han_viet_vectorstore.pkl",
+                        help="File .pkl local; nếu không có sẽ load từ Hugging Face")
+    parser.add_argument('--threshold', type=float, default=0.7)
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch_parser = subparsers.add_parser('batch', help="Dịch hàng loạt cả file .txt/.csv")
+    batch_parser.add_argument('input', help="File .txt (mỗi dòng một câu) hoặc .csv")
+    batch_parser.add_argument('output', help="File kết quả .csv hoặc .jsonl")
+    batch_parser.add_argument('--column', default=None, help="Cột chứa câu tiếng Hán trong file .csv")
+    batch_parser.add_argument('--batch-size', type=int, default=64)
+    batch_parser.add_argument('--threads', type=int, default=None, help="Số luồng torch (mặc định: tất cả CPU)")
+    batch_parser.add_argument('--no-resume', action='store_true', help="Bỏ qua checkpoint, dịch lại từ đầu (ghi đè file output)")
+    batch_parser.add_argument('--autotune', nargs='?', const="encoder_tuning.json", default=None, metavar='FILE',
+                              help="Chọn số luồng/batch size encoder theo phần cứng (lưu vào FILE)")
+
+    args = parser.parse_args(argv)
+    translator = HanVietTranslator(threshold=args.threshold, model_path=args.model_path)
+
+    if args.command == 'batch':
+        try:
+            total = translate_file(
+                translator, args.input, args.output, column=args.column,
+                batch_size=args.batch_size, resume=not args.no_resume, threads=args.threads,
+                tuning_path=args.autotune
+            )
+            print(f"Hoàn tất: {total} câu -> {args.output}")
+        except Exception as e:
+            print(f"Lỗi: {str(e)}")
+            sys.exit(1)
+    else:
+        interactive(translator)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
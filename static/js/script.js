@@ -1,6 +1,7 @@
 // DOM Elements
 const searchForm = document.getElementById('searchForm');
 const hanInput = document.getElementById('hanInput');
+const directionSelect = document.getElementById('directionSelect');
 const clearBtn = document.getElementById('clearBtn');
 const searchBtn = document.getElementById('searchBtn');
 const loading = document.getElementById('loading');
@@ -101,9 +102,10 @@ async function handleSearch(e) {
     e.preventDefault();
     
     const query = hanInput.value.trim();
+    const direction = directionSelect ? directionSelect.value : 'han2vi';
     
     if (!query) {
-        showError('Vui lòng nhập câu tiếng Hán cần tìm kiếm.');
+        showError(direction === 'vi2han' ? 'Vui lòng nhập câu tiếng Việt cần tìm kiếm.' : 'Vui lòng nhập câu tiếng Hán cần tìm kiếm.');
         return;
     }
     
@@ -131,14 +133,15 @@ async function handleSearch(e) {
             console.warn('Model init error, continuing with search:', initErr);
         }
         
-        // Sau đó thực hiện search
-        const response = await fetch('/api/search', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({ query: query })
-        });
+        // Đoạn văn nhiều câu: tìm theo từng câu và hiển thị dần (chỉ chiều Hán -> Việt)
+        if (direction === 'han2vi' && isPassage(query)) {
+            await searchPassage(query);
+            return;
+        }
+        
+        // Sau đó thực hiện search (GET để trình duyệt cache lại kết quả theo ETag)
+        const params = new URLSearchParams({ query: query, direction: direction, compact: '1' });
+        const response = await fetch('/api/search?' + params.toString());
         
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
@@ -168,6 +171,94 @@ async function handleSearch(e) {
     }
 }
 
+// Tách câu theo cùng bộ dấu câu với split_passage ở server
+// Chỉ dấu kết câu; ；： nằm giữa câu nên một câu có ；： vẫn được tìm như một câu
+const PASSAGE_DELIMITERS = /[。！？!?\n]/;
+
+function isPassage(query) {
+    const segments = query.split(PASSAGE_DELIMITERS).filter(s => s.trim());
+    return segments.length > 1;
+}
+
+async function searchPassage(query) {
+    const response = await fetch('/api/search-passage', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ query: query })
+    });
+    
+    if (!response.ok || !response.body) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    
+    allResults.innerHTML = '';
+    allResults.classList.remove('hidden');
+    resultCount.textContent = 0;
+    results.classList.remove('hidden');
+    
+    // Đọc từng dòng JSON ngay khi server gửi về
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let received = 0;
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        
+        for (const line of lines) {
+            if (!line.trim()) {
+                continue;
+            }
+            const segmentData = JSON.parse(line);
+            if (segmentData.done) {
+                if (segmentData.error) {
+                    showError(segmentData.error);
+                }
+                continue;
+            }
+            received += 1;
+            resultCount.textContent = received;
+            allResults.appendChild(createSegmentCard(segmentData));
+        }
+    }
+}
+
+function createSegmentCard(segmentData) {
+    const best = segmentData.best_result;
+    const card = best
+        ? createResultCard(best, segmentData.index + 1)
+        : document.createElement('div');
+    
+    if (!best) {
+        card.className = 'result-card';
+        card.innerHTML = `
+            <div class="result-card-header">
+                <div class="result-card-title">Kết quả ${segmentData.index + 1}</div>
+            </div>
+            <div class="result-content">
+                <p class="result-text">Không tìm thấy kết quả phù hợp</p>
+            </div>
+        `;
+    }
+    
+    const segmentItem = document.createElement('div');
+    segmentItem.className = 'result-item';
+    segmentItem.innerHTML = `
+        <label>Câu nhập:</label>
+        <p class="result-text">${escapeHtml(segmentData.segment || '')}</p>
+    `;
+    card.querySelector('.result-content').prepend(segmentItem);
+    return card;
+}
+
 function setSearchingState(searching) {
     searchBtn.disabled = searching;
     
@@ -181,7 +272,9 @@ function setSearchingState(searching) {
 }
 
 function displayResults(data) {
-    const { results: searchResults, best_result } = data;
+    const { results: searchResults } = data;
+    // Response dạng compact không có best_result, kết quả tốt nhất là phần tử đầu tiên
+    const best_result = data.best_result || (searchResults && searchResults[0]);
     
     // Update result count
     resultCount.textContent = searchResults ? searchResults.length : 0;
@@ -306,6 +399,7 @@ function hideError() {
 function hideResults() {
     results.classList.add('hidden');
     bestResult.classList.add('hidden');
+    allResults.classList.add('hidden');
 }
 
 function escapeHtml(text) {